@@ -0,0 +1,16 @@
+"""
+Нагрузочное тестирование сайта объявлений.
+
+Генерация синтетической базы:
+    python -m bench generate bench.db --listings 500000 --users 50000 --favorites 1000000
+
+Замер маршрутов через тестовый клиент Flask (без сети):
+    python -m bench run bench.db --requests 200 --output before.json
+
+Замер по HTTP с параллельными клиентами (поднимает локальный сервер,
+либо используйте --url для уже запущенного):
+    python -m bench run bench.db --mode http --concurrency 16 --output before.json
+
+Сравнение двух замеров:
+    python -m bench compare before.json after.json
+"""
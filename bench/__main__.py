@@ -0,0 +1,75 @@
+"""
+Командная строка пакета bench (см. описание в bench/__init__.py).
+"""
+import argparse
+import json
+import os
+import sys
+
+from bench import dataset, runner
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m bench', description='Нагрузочное тестирование сайта объявлений')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    generate = commands.add_parser('generate', help='создать синтетическую базу данных')
+    generate.add_argument('database')
+    generate.add_argument('--listings', type=int, default=500000)
+    generate.add_argument('--users', type=int, default=50000)
+    generate.add_argument('--favorites', type=int, default=1000000)
+    generate.add_argument('--seed', type=int, default=1)
+    generate.add_argument('--force', action='store_true', help='перезаписать существующую базу')
+
+    run = commands.add_parser('run', help='замерить маршруты')
+    run.add_argument('database')
+    run.add_argument('--mode', choices=['client', 'http'], default='client')
+    run.add_argument('--url', help='адрес уже запущенного сервера (для --mode http)')
+    run.add_argument('--routes', help='маршруты через запятую: ' + ', '.join(runner.ROUTES))
+    run.add_argument('--requests', type=int, default=200, help='запросов на маршрут')
+    run.add_argument('--concurrency', type=int, default=1)
+    run.add_argument('--warmup', type=int, default=20)
+    run.add_argument('--no-cache', action='store_true', help='отключить кэши приложения (поиск, карточки, избранное)')
+    run.add_argument('--seed', type=int, default=1)
+    run.add_argument('--output', help='файл для результатов в JSON (по умолчанию - stdout)')
+
+    compare = commands.add_parser('compare', help='сравнить два замера')
+    compare.add_argument('before')
+    compare.add_argument('after')
+
+    args = parser.parse_args(argv)
+    log = lambda message: print(message, file=sys.stderr)
+
+    if args.command == 'generate':
+        if os.path.exists(args.database):
+            if not args.force:
+                parser.error(f'{args.database} уже существует (используйте --force)')
+            for suffix in ('', '-wal', '-shm'):
+                if os.path.exists(args.database + suffix):
+                    os.remove(args.database + suffix)
+        dataset.generate(args.database, args.listings, args.users, args.favorites, args.seed, echo=log)
+
+    elif args.command == 'run':
+        routes = args.routes.split(',') if args.routes else None
+        unknown = set(routes or ()) - set(runner.ROUTES)
+        if unknown:
+            parser.error('неизвестные маршруты: ' + ', '.join(sorted(unknown)))
+        result = runner.run(args.database, args.mode, routes, args.requests, args.concurrency, args.warmup,
+                            args.url, not args.no_cache, args.seed, echo=log)
+        text = json.dumps(result, ensure_ascii=False, indent=2)
+        if args.output:
+            with open(args.output, 'w', encoding='utf-8') as f:
+                f.write(text + '\n')
+        else:
+            print(text)
+
+    else:
+        with open(args.before, encoding='utf-8') as f:
+            before = json.load(f)
+        with open(args.after, encoding='utf-8') as f:
+            after = json.load(f)
+        runner.compare(before, after)
+
+
+if __name__ == '__main__':
+    main()
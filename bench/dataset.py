@@ -0,0 +1,125 @@
+"""
+Генератор синтетической базы данных: пользователи, объявления и избранное
+с реалистичным распределением по городам, типам жилья, комнатам и ценам.
+"""
+import random
+import time
+
+from werkzeug.security import generate_password_hash
+
+import server
+
+# Пароль всех сгенерированных пользователей (и администратора "admin")
+PASSWORD = 'benchmark1'
+
+# Города: (название, вес, широта центра, долгота центра, множитель цены)
+CITIES = [
+    ('Минск', 40, 53.9023, 27.5619, 1.0),
+    ('Гомель', 10, 52.4345, 30.9754, 0.6),
+    ('Могилев', 8, 53.9168, 30.3449, 0.55),
+    ('Витебск', 8, 55.1904, 30.2049, 0.55),
+    ('Гродно', 8, 53.6694, 23.8131, 0.6),
+    ('Брест', 7, 52.0976, 23.7341, 0.6),
+    ('Бобруйск', 5, 53.1446, 29.2214, 0.45),
+    ('Барановичи', 4, 53.1327, 26.0139, 0.45),
+    ('Борисов', 4, 54.2279, 28.5050, 0.45),
+    ('Пинск', 3, 52.1229, 26.0951, 0.4),
+    ('Орша', 3, 54.5081, 30.4172, 0.4),
+]
+
+# Типы жилья: (название, вес, варианты количества комнат, веса вариантов)
+HOUSING = [
+    ('квартира', 70, [1, 2, 3, 4], [35, 35, 22, 8]),
+    ('дом', 15, [2, 3, 4, 5, 6, 7], [10, 30, 30, 15, 10, 5]),
+    ('комната', 15, [1], [1]),
+]
+
+DETAILS = ['рядом с метро', 'балкон', 'парковка', 'евроремонт', 'мебель и техника',
+           'можно с животными', 'высокий этаж', 'вид на парк', 'новостройка', 'рядом школа',
+           'тихий двор', 'раздельный санузел', 'кладовка', 'охраняемая территория']
+EXTRAS = ['Хозяин без посредников.', 'Документы готовы.', 'Возможен торг.',
+          'Свежий ремонт.', 'Развитая инфраструктура.', 'Удобная транспортная развязка.']
+
+
+def _make_listing(rnd, user_count):
+    """
+    Одно случайное объявление (кортеж значений в порядке LISTING_COLUMNS).
+    """
+    city, _, lat, lon, multiplier = rnd.choices(CITIES, weights=[c[1] for c in CITIES])[0]
+    housing, _, rooms_options, rooms_weights = rnd.choices(HOUSING, weights=[h[1] for h in HOUSING])[0]
+    rooms = rnd.choices(rooms_options, weights=rooms_weights)[0]
+    area = rooms * rnd.randint(14, 22) + rnd.randint(8, 20)
+    if housing == 'комната':
+        area = rnd.randint(10, 25)
+    deal_type = 'rent' if rnd.random() < 0.6 else 'sale'
+    if deal_type == 'rent':
+        price = int(area * rnd.uniform(8, 14) * multiplier) // 10 * 10
+        verb = 'Сдается'
+    else:
+        price = int(area * rnd.uniform(1500, 2500) * multiplier) // 1000 * 1000
+        verb = 'Продается'
+    description = f"{verb} {housing}, {rooms} комн., {area} м², {city}. {rnd.choice(EXTRAS)}"
+    details = ', '.join(rnd.sample(DETAILS, rnd.randint(2, 4)))
+    phone = f"+375 {rnd.choice(['29', '33', '44', '25'])} {rnd.randint(1000000, 9999999)}"
+    return (price, rooms, description, details, deal_type, housing, city, area, phone,
+            rnd.randint(1, user_count), lat + rnd.gauss(0, 0.04), lon + rnd.gauss(0, 0.06))
+
+
+LISTING_COLUMNS = ('price', 'rooms', 'description', 'details', 'deal_type', 'housing_type', 'city',
+                   'area', 'phone', 'user_id', 'latitude', 'longitude')
+
+
+def generate(path, listings=500000, users=50000, favorites=1000000, seed=1, batch_size=10000, echo=print):
+    """
+    Создает базу path и заполняет ее синтетическими данными.
+    Первый пользователь - администратор "admin", остальные - user000001, user000002, ...
+    Объявления загружаются с отложенным построением индексов (как в import-listings).
+    Возвращает словарь с количеством созданных строк.
+    """
+    rnd = random.Random(seed)
+    started = time.perf_counter()
+    server.app.config['DATABASE'] = path
+    server.init_db()
+    conn = server.connect_db(path)
+    # Один хеш на всех: хеширование пароля для каждого пользователя заняло бы слишком много времени
+    password_hash = generate_password_hash(PASSWORD, server.app.config['PASSWORD_HASH_METHOD'])
+
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        conn.execute("INSERT INTO users (username, password, role, display_name) VALUES ('admin', ?, 0, 'Администратор')",
+                     (password_hash,))
+        conn.executemany(
+            'INSERT INTO users (username, password, role, display_name) VALUES (?, ?, 1, ?)',
+            ((f'user{n:06d}', password_hash, f'Пользователь {n}') for n in range(1, users)))
+        echo(f'users: {users} ({time.perf_counter() - started:.1f} с)')
+
+        last_id = conn.execute('SELECT COALESCE(MAX(id), 0) FROM listings').fetchone()[0]
+        deferred = server._drop_deferred_listing_objects(conn)
+        placeholders = ', '.join('?' for _ in LISTING_COLUMNS)
+        sql = f"INSERT INTO listings ({', '.join(LISTING_COLUMNS)}) VALUES ({placeholders})"
+        for start in range(0, listings, batch_size):
+            count = min(batch_size, listings - start)
+            conn.executemany(sql, (_make_listing(rnd, users) for _ in range(count)))
+        server._restore_deferred_listing_objects(conn, deferred, last_id)
+        echo(f'listings: {listings} ({time.perf_counter() - started:.1f} с)')
+
+        # Избранное: популярные объявления встречаются чаще (квадрат равномерного распределения)
+        added = 0
+        while added < favorites and listings and users:
+            count = min(batch_size, favorites - added)
+            # rowcount - только добавленные строки favorites (без повторов и без изменений,
+            # сделанных триггерами ревизии избранного, которые попадают в total_changes)
+            added += conn.executemany(
+                'INSERT OR IGNORE INTO favorites (user_id, listing_id) VALUES (?, ?)',
+                ((rnd.randint(1, users), last_id + 1 + int(listings * rnd.random() ** 2)) for _ in range(count))).rowcount
+        echo(f'favorites: {added} ({time.perf_counter() - started:.1f} с)')
+
+        server.bump_listings_version(conn)
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        raise
+    conn.execute('ANALYZE')
+    conn.close()
+    echo(f'готово за {time.perf_counter() - started:.1f} с')
+    return {'users': users, 'listings': listings, 'favorites': added}
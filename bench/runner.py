@@ -0,0 +1,272 @@
+"""
+Замер маршрутов: через тестовый клиент Flask или по HTTP с параллельными клиентами.
+Результат - JSON с пропускной способностью и перцентилями задержки по каждому маршруту.
+"""
+import http.cookiejar
+import math
+import platform
+import random
+import sqlite3
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
+from werkzeug.serving import WSGIRequestHandler, make_server
+
+import server
+from bench.dataset import PASSWORD
+
+
+def load_meta(path):
+    """
+    Читает из базы то, что нужно для построения запросов: диапазон id, города, имена пользователей.
+    """
+    conn = sqlite3.connect(path)
+    try:
+        max_listing = conn.execute('SELECT COALESCE(MAX(id), 0) FROM listings').fetchone()[0]
+        users = [row[0] for row in conn.execute("SELECT username FROM users WHERE role = 1 LIMIT 1000")]
+        cities = [row[0] for row in conn.execute(
+            'SELECT city FROM listings GROUP BY city ORDER BY COUNT(*) DESC LIMIT 20')]
+    finally:
+        conn.close()
+    return {'max_listing': max_listing, 'users': users, 'cities': cities or ['Минск']}
+
+
+def _listing_filters(rnd, meta):
+    """
+    Случайный набор фильтров страниц /rent и /sale (часть запросов - без фильтров).
+    """
+    params = {}
+    if rnd.random() < 0.7:
+        params['city'] = rnd.choice(meta['cities'])
+    if rnd.random() < 0.5:
+        params['rooms'] = rnd.randint(1, 4)
+    if rnd.random() < 0.3:
+        params['housing_type'] = rnd.choice(['квартира', 'дом'])
+    if rnd.random() < 0.4:
+        low = rnd.choice([100, 300, 500, 1000, 30000, 60000])
+        params['min_price'] = low
+        params['max_price'] = low * rnd.choice([2, 3, 5])
+    if rnd.random() < 0.2:
+        params['sort'] = 'price'
+    return params
+
+
+def _url(path, params=None):
+    # Параметры по алфавиту - канонический вид адреса страниц поиска (иначе ответ - перенаправление)
+    return path + ('?' + urllib.parse.urlencode(sorted(params.items())) if params else '')
+
+
+# Маршруты: имя -> (роль пользователя или None для анонимного, функция построения URL)
+ROUTES = {
+    'rent': (None, lambda rnd, meta: _url('/rent', _listing_filters(rnd, meta))),
+    'sale': (None, lambda rnd, meta: _url('/sale', _listing_filters(rnd, meta))),
+    'listing_detail': (None, lambda rnd, meta: f"/listing/{rnd.randint(1, max(1, meta['max_listing']))}"),
+    'favorites': ('user', lambda rnd, meta: '/favorites'),
+    'admin_listings': ('admin', lambda rnd, meta: _url('/admin/listings', {
+        'city': rnd.choice(meta['cities']), 'sort_by': rnd.choice(['id', 'price']),
+        'order': rnd.choice(['asc', 'desc'])})),
+}
+
+
+def percentile(sorted_values, p):
+    """
+    Перцентиль методом ближайшего ранга.
+    """
+    if not sorted_values:
+        return None
+    rank = max(1, math.ceil(p / 100 * len(sorted_values)))
+    return sorted_values[rank - 1]
+
+
+def summarize(latencies, errors, elapsed):
+    """
+    Сводка по одному маршруту (время - в миллисекундах).
+    """
+    values = sorted(latencies)
+    ms = lambda value: round(value * 1000, 3) if value is not None else None
+    return {
+        'requests': len(values),
+        'errors': errors,
+        'throughput_rps': round(len(values) / elapsed, 1) if elapsed else None,
+        'mean_ms': ms(sum(values) / len(values)) if values else None,
+        'p50_ms': ms(percentile(values, 50)),
+        'p95_ms': ms(percentile(values, 95)),
+        'p99_ms': ms(percentile(values, 99)),
+        'max_ms': ms(values[-1]) if values else None,
+    }
+
+
+class QuietRequestHandler(WSGIRequestHandler):
+    """
+    Обработчик локального сервера без записи каждого запроса в журнал.
+    """
+
+    def log_request(self, *args, **kwargs):
+        pass
+
+
+class ClientWorker:
+    """
+    Рабочий тестового клиента Flask: запросы без сети, внутри этого процесса.
+    """
+
+    def __init__(self, role, username):
+        self.client = server.app.test_client()
+        if role:
+            # Входим через форму, как настоящий пользователь
+            self.client.post('/login', data={'username': 'admin' if role == 'admin' else username,
+                                             'password': PASSWORD})
+
+    def get(self, url):
+        response = self.client.get(url)
+        # Тело читается целиком: страницы /rent и /sale отдаются потоком,
+        # и запрос к базе и отрисовка шаблона выполняются только при чтении
+        response.get_data()
+        response.close()
+        return response.status_code
+
+
+class HttpWorker:
+    """
+    Рабочий HTTP-клиента: свое соединение и свои cookie (сессия входа).
+    """
+
+    def __init__(self, base_url, role, username):
+        self.base_url = base_url.rstrip('/')
+        self.opener = urllib.request.build_opener(
+            urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()))
+        if role:
+            data = urllib.parse.urlencode({'username': 'admin' if role == 'admin' else username,
+                                           'password': PASSWORD}).encode()
+            self.opener.open(self.base_url + '/login', data=data).read()
+
+    def get(self, url):
+        try:
+            with self.opener.open(self.base_url + url) as response:
+                response.read()
+                return response.status
+        except urllib.error.HTTPError as error:
+            return error.code
+
+
+def run_route(name, make_worker, meta, requests, concurrency, warmup, seed):
+    """
+    Замер одного маршрута: warmup запросов для прогрева, затем requests запросов
+    в concurrency потоков. Запрос с ответом не 200 считается ошибкой.
+    """
+    role, build_url = ROUTES[name]
+    rnd = random.Random(seed)
+    urls = [build_url(rnd, meta) for _ in range(warmup + requests)]
+    workers = [make_worker(role, rnd.choice(meta['users']) if meta['users'] else 'admin')
+               for _ in range(concurrency)]
+    for url in urls[:warmup]:
+        workers[0].get(url)
+
+    latencies = []
+    errors = 0
+    lock = threading.Lock()
+
+    def work(index):
+        nonlocal errors
+        worker = workers[index]
+        local = []
+        local_errors = 0
+        for url in urls[warmup + index::concurrency]:
+            started = time.perf_counter()
+            status = worker.get(url)
+            local.append(time.perf_counter() - started)
+            local_errors += status != 200
+        with lock:
+            latencies.extend(local)
+            errors += local_errors
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as pool:
+        list(pool.map(work, range(concurrency)))
+    return summarize(latencies, errors, time.perf_counter() - started)
+
+
+def run(path, mode='client', routes=None, requests=200, concurrency=1, warmup=20, url=None,
+        use_cache=True, seed=1, echo=print):
+    """
+    Замер маршрутов на базе path. mode='client' - тестовый клиент Flask,
+    mode='http' - HTTP-запросы к url (или к локальному серверу, поднятому на время замера).
+    use_cache=False отключает все кэши приложения в памяти процесса: результаты поиска,
+    отрисованные карточки и списки избранного (только для замеров внутри процесса, то есть
+    без url). Условные запросы (ETag/304) не мешают замеру: клиенты не присылают If-None-Match.
+    Возвращает словарь для сохранения в JSON.
+    """
+    server.app.config['DATABASE'] = path
+    server.init_db()
+    if not use_cache:
+        for setting in ('LISTINGS_CACHE_SIZE', 'CARD_CACHE_SIZE', 'FAVORITES_CACHE_SIZE'):
+            server.app.config[setting] = 0
+    meta = load_meta(path)
+    routes = routes or list(ROUTES)
+
+    httpd = None
+    if mode == 'http' and not url:
+        httpd = make_server('127.0.0.1', 0, server.app, threaded=True, request_handler=QuietRequestHandler)
+        threading.Thread(target=httpd.serve_forever, daemon=True).start()
+        url = f'http://127.0.0.1:{httpd.server_port}'
+    if mode == 'http':
+        make_worker = lambda role, username: HttpWorker(url, role, username)
+    else:
+        make_worker = ClientWorker
+
+    results = {}
+    try:
+        for name in routes:
+            results[name] = run_route(name, make_worker, meta, requests, concurrency, warmup, seed)
+            r = results[name]
+            echo(f"{name:16} {r['throughput_rps']:>8} rps  p50 {r['p50_ms']:>9} ms  "
+                 f"p95 {r['p95_ms']:>9} ms  p99 {r['p99_ms']:>9} ms  errors {r['errors']}")
+    finally:
+        if httpd:
+            httpd.shutdown()
+
+    return {
+        'meta': {
+            'timestamp': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+            'mode': mode,
+            'url': url if mode == 'http' else None,
+            'requests': requests,
+            'concurrency': concurrency,
+            'warmup': warmup,
+            'cache': use_cache,
+            # Потоковая отдача /rent и /sale: время замера включает чтение всего тела
+            'listings_stream': server.app.config['LISTINGS_STREAM'],
+            'seed': seed,
+            'database': path,
+            'listings': meta['max_listing'],
+            'python': platform.python_version(),
+            'sqlite': sqlite3.sqlite_version,
+        },
+        'routes': results,
+    }
+
+
+def compare(old, new, echo=print):
+    """
+    Печатает изменение пропускной способности и перцентилей между двумя замерами.
+    Отрицательный процент у задержки и положительный у rps - улучшение.
+    """
+    def change(before, after):
+        if not before or after is None:
+            return '     n/a'
+        return f'{(after - before) / before * 100:+7.1f}%'
+
+    echo(f"{'route':16} {'rps':>8} {'p50':>8} {'p95':>8} {'p99':>8}")
+    for name, after in new['routes'].items():
+        before = old['routes'].get(name)
+        if before is None:
+            echo(f'{name:16} (нет в первом замере)')
+            continue
+        echo(f"{name:16} {change(before['throughput_rps'], after['throughput_rps'])} "
+             f"{change(before['p50_ms'], after['p50_ms'])} {change(before['p95_ms'], after['p95_ms'])} "
+             f"{change(before['p99_ms'], after['p99_ms'])}")
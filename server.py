@@ -1,9 +1,47 @@
-from flask import Flask, render_template, request, redirect, url_for, session, flash
+from flask import Flask, render_template, request, redirect, url_for, session, flash, g, jsonify, abort, stream_with_context, \
+    has_request_context, before_render_template, template_rendered, get_template_attribute, stream_template, \
+    get_flashed_messages
+from jinja2 import FileSystemBytecodeCache  # Для кэша скомпилированных шаблонов между перезапусками
 import sqlite3  # Для работы с базой данных SQLite
+import threading  # Для хранения соединений с базой данных по потокам
 from werkzeug.security import generate_password_hash, check_password_hash  # Для хеширования и проверки паролей
 from functools import wraps  # Для создания декораторов
+from collections import namedtuple, OrderedDict  # Для легковесных типов строк и LRU-кэша
 import os  # Для работы с операционной системой (например, пути к файлам)
-from werkzeug.utils import secure_filename  # Для безопасной обработки имен файлов
+import re  # Для разбора поисковых запросов
+import math  # Для расстояний между координатами объявлений
+import time  # Для времени жизни записей кэша
+import json  # Для хранения списка вариантов изображений
+import hashlib  # Для адресации загруженных файлов по хешу содержимого
+import tempfile  # Для временных файлов при потоковой записи загрузок
+import shutil  # Для копирования файлов загрузок
+import glob  # Для поиска уменьшенных копий файла загрузки
+import gzip  # Для предварительного сжатия статических файлов и сжатия ответов
+import zlib  # Для потокового сжатия ответов gzip
+import csv  # Для импорта и экспорта объявлений в CSV
+import itertools  # Для разбиения импорта на порции
+import click  # Для команд flask CLI (входит в зависимости Flask)
+import hmac  # Для сравнения токена доступа к метрикам
+import multiprocessing  # Для пула процессов хеширования паролей
+import signal  # Для управления рабочими процессами сервера
+import socket  # Для общего слушающего сокета рабочих процессов
+import sys  # Для перезапуска сервера с новым кодом
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FuturesTimeoutError  # Для пула хеширования паролей
+from concurrent.futures import ThreadPoolExecutor  # Для пула потоков рабочего процесса сервера
+from concurrent.futures.process import BrokenProcessPool
+from werkzeug.exceptions import RequestEntityTooLarge, ServiceUnavailable  # Превышение MAX_CONTENT_LENGTH и перегрузка (503)
+from werkzeug.serving import BaseWSGIServer, WSGIRequestHandler  # Основа HTTP-сервера рабочих процессов
+try:
+    from PIL import Image, ImageOps  # Для уменьшенных копий загруженных фотографий (необязательная зависимость)
+except ImportError:
+    Image = ImageOps = None
+try:
+    import brotli  # Для сжатия статических файлов в формате brotli (необязательная зависимость)
+except ImportError:
+    brotli = None
+
+# Время начала загрузки приложения (для отчета о запуске сервера)
+_module_loaded_at = time.perf_counter()
 
 # Инициализация Flask приложения
 app = Flask(__name__)
@@ -13,22 +51,190 @@ app.secret_key = 'your_secret_key'
 app.config['ALLOWED_EXTENSIONS'] = {'png', 'jpg', 'jpeg', 'gif'}
 # Папка для сохранения загруженных файлов
 app.config['UPLOAD_FOLDER'] = 'static/uploads'
+# Максимальный размер тела запроса (в байтах): больший запрос отклоняется до чтения тела
+app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024
+# Ширина (в пикселях) уменьшенных копий загруженных фотографий:
+# card - карточка в списках, detail - страница объявления, avatar - фото профиля (квадрат)
+app.config['IMAGE_VARIANTS'] = {'card': 480, 'detail': 1280, 'avatar': 200}
+# Качество сжатия копий в WebP и JPEG
+app.config['IMAGE_QUALITY'] = 80
+# Сколько файлов загрузок без ссылок удаляется за одну транзакцию фоновой очистки
+app.config['UPLOAD_CLEANUP_BATCH'] = 100
+# Сборка мусора в папке загрузок (flask gc-uploads): файлы без ссылок младше этого
+# возраста (в секундах) не удаляются, и сколько файлов в секунду просматривать
+app.config['UPLOAD_GC_GRACE_PERIOD'] = 24 * 3600
+app.config['UPLOAD_GC_RATE'] = 1000
+# Минифицировать ли CSS при сборке манифеста статических файлов
+app.config['ASSET_MINIFY'] = True
+# Сборки CSS: имя сборки -> список файлов из static/, которые склеиваются в один
+# (например {'site.css': ['base.css', 'rent.css']}; в шаблоне - asset_url('site.css'))
+app.config['ASSET_BUNDLES'] = {}
+# Время кэширования файлов с хешем в имени (в секундах, один год)
+app.config['ASSET_MAX_AGE'] = 365 * 24 * 3600
+# Максимальное количество объявлений в ответе поиска по карте
+app.config['MAP_LISTINGS_LIMIT'] = 500
+# Максимальный радиус поиска по карте (в километрах)
+app.config['MAP_MAX_RADIUS_KM'] = 200
+# Максимальный размер страницы в JSON API
+app.config['API_MAX_PAGE_SIZE'] = 100
+# Сколько строк читается из базы за раз при потоковой выгрузке NDJSON
+app.config['API_STREAM_BATCH_SIZE'] = 500
+# Метод хеширования паролей (алгоритм и стоимость); при входе старые хеши пересчитываются этим методом
+app.config['PASSWORD_HASH_METHOD'] = 'scrypt:32768:8:1'
+# Количество процессов для хеширования паролей (0 - хешировать в потоке запроса)
+app.config['PASSWORD_HASH_WORKERS'] = min(4, os.cpu_count() or 1)
+# Сколько операций на один процесс может ждать в очереди
+app.config['PASSWORD_HASH_QUEUE'] = 8
+# Сколько секунд ждать места в очереди и результата (после этого - ответ 503)
+app.config['PASSWORD_HASH_TIMEOUT'] = 10
+# Замерять ли каждый SQL-запрос (количество и время запросов в метриках, журнал медленных запросов)
+app.config['SQL_METRICS'] = True
+# SQL-запросы дольше этого времени (в миллисекундах) пишутся в журнал
+app.config['SLOW_QUERY_MS'] = 100
+# Токен для сбора метрик без входа на сайт (заголовок Authorization: Bearer <токен>); None - только администратор
+app.config['METRICS_TOKEN'] = os.environ.get('METRICS_TOKEN')
+# Количество рабочих процессов и потоков в каждом из них (flask serve)
+app.config['SERVER_WORKERS'] = os.cpu_count() or 1
+app.config['SERVER_THREADS'] = 8
+# Очередь соединений слушающего сокета
+app.config['SERVER_BACKLOG'] = 1024
+# Сколько секунд ждать данных от клиента (медленный клиент не должен занимать поток бесконечно)
+app.config['SERVER_CLIENT_TIMEOUT'] = 30
+# Сколько секунд рабочий процесс может завершать начатые запросы при остановке и перезагрузке
+app.config['SERVER_GRACEFUL_TIMEOUT'] = 30
+# Путь к файлу базы данных SQLite
+app.config['DATABASE'] = 'users.db'
+# Размер области memory-mapped I/O для SQLite (в байтах)
+app.config['SQLITE_MMAP_SIZE'] = 256 * 1024 * 1024
+# Размер страничного кэша SQLite (отрицательное значение - в килобайтах)
+app.config['SQLITE_CACHE_SIZE'] = -64 * 1024
+# Сколько миллисекунд ждать снятия блокировки записи другим соединением
+app.config['SQLITE_BUSY_TIMEOUT'] = 5000
+# Количество объявлений на одной странице /rent и /sale
+app.config['LISTINGS_PAGE_SIZE'] = 20
+# Сколько символов описания и деталей показывать в карточке объявления в списках
+app.config['LISTING_SNIPPET_LENGTH'] = 160
+# Сколько страниц результатов поиска хранить в кэше и сколько секунд
+app.config['LISTINGS_CACHE_SIZE'] = 512
+app.config['LISTINGS_CACHE_TTL'] = 60
+# Сжимать ответы gzip/brotli, если браузер это поддерживает
+app.config['COMPRESS_ENABLED'] = True
+# Ответы меньше этого размера (в байтах) не сжимаются
+app.config['COMPRESS_MIN_SIZE'] = 500
+# Уровень сжатия gzip (1-9) и качество brotli (0-11) для ответов, сжимаемых на лету
+app.config['COMPRESS_LEVEL'] = 6
+app.config['COMPRESS_BROTLI_QUALITY'] = 5
+# Нетекстовые типы, которые тоже стоит сжимать (text/* сжимаются всегда)
+app.config['COMPRESS_MIMETYPES'] = {'application/json', 'application/x-ndjson', 'application/javascript',
+                                    'image/svg+xml'}
+# Отдавать страницы /rent и /sale потоком: шапка и форма поиска уходят клиенту до запроса к базе
+app.config['LISTINGS_STREAM'] = True
+# Минимальный размер части потокового ответа в символах (мелкие части шаблона объединяются)
+app.config['STREAM_CHUNK_SIZE'] = 8192
+# Сколько секунд кэширующий прокси может отдавать страницы поиска анонимным посетителям без перепроверки
+app.config['PUBLIC_PAGE_MAX_AGE'] = 60
+# Количество строк на одной странице таблиц админки
+app.config['ADMIN_PAGE_SIZE'] = 50
+# До какого значения строки в таблицах админки считаются точно (дальше - приблизительная оценка)
+app.config['ADMIN_COUNT_LIMIT'] = 10000
+# Для скольких пользователей хранить в кэше список избранного и сколько секунд
+app.config['FAVORITES_CACHE_SIZE'] = 4096
+app.config['FAVORITES_CACHE_TTL'] = 300
+# Сколько отрисованных карточек объявлений хранить в кэше и сколько секунд
+app.config['CARD_CACHE_SIZE'] = 20000
+app.config['CARD_CACHE_TTL'] = 3600
+# Каталог кэша скомпилированных шаблонов Jinja (None - подкаталог временного каталога системы)
+app.config['JINJA_BYTECODE_CACHE_DIR'] = None
 
 # ---------- ИНИЦИАЛИЗАЦИЯ БАЗЫ ДАННЫХ ----------
 # Функции и код, связанные с созданием и настройкой базы данных.
 
-def init_db():
+# Хранилище соединений: у каждого рабочего потока свое соединение,
+# которое переиспользуется между запросами этого потока.
+_db_local = threading.local()
+
+# Средний радиус Земли (км) - для расстояний в поиске по карте
+EARTH_RADIUS_KM = 6371.0088
+
+
+def distance_km(lat1, lon1, lat2, lon2):
     """
-    Инициализирует базу данных, создает таблицы, если они еще не существуют.
+    Расстояние между двумя точками по поверхности Земли (формула гаверсинусов), в километрах.
+    Регистрируется в SQLite как функция distance_km() для поиска в радиусе.
     """
-    # Устанавливаем соединение с файлом базы данных 'users.db'
-    conn = sqlite3.connect('users.db')
-    # Создаем курсор для выполнения SQL-запросов
-    c = conn.cursor()
+    if None in (lat1, lon1, lat2, lon2):
+        return None
+    lat1, lon1, lat2, lon2 = map(math.radians, (lat1, lon1, lat2, lon2))
+    a = (math.sin((lat2 - lat1) / 2) ** 2
+         + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2)
+    return 2 * EARTH_RADIUS_KM * math.asin(min(1.0, math.sqrt(a)))
+
+
+def connect_db(path=None):
+    """
+    Открывает новое соединение с базой данных и настраивает его через PRAGMA.
+    WAL позволяет читателям не блокироваться на время записи,
+    synchronous=NORMAL в режиме WAL безопасен и заметно ускоряет commit.
+    """
+    conn = sqlite3.connect(path or app.config['DATABASE'],
+                           timeout=app.config['SQLITE_BUSY_TIMEOUT'] / 1000,
+                           # Замер SQL-запросов для метрик (можно отключить через SQL_METRICS)
+                           factory=InstrumentedConnection if app.config['SQL_METRICS'] else sqlite3.Connection)
+    # Доступ к колонкам по именам (row['price']) и по индексам (row[0])
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA journal_mode = WAL")
+    conn.execute("PRAGMA synchronous = NORMAL")
+    conn.execute(f"PRAGMA mmap_size = {int(app.config['SQLITE_MMAP_SIZE'])}")
+    conn.execute(f"PRAGMA cache_size = {int(app.config['SQLITE_CACHE_SIZE'])}")
+    conn.execute("PRAGMA foreign_keys = ON")
+    conn.execute("PRAGMA temp_store = MEMORY")
+    conn.create_function('distance_km', 4, distance_km, deterministic=True)
+    return conn
+
+def get_db():
+    """
+    Возвращает соединение с базой данных для текущего запроса.
+    Соединение берется из хранилища потока (или создается при первом обращении)
+    и запоминается в контексте приложения Flask (g) до конца запроса.
+    """
+    if 'db' not in g:
+        path = app.config['DATABASE']
+        conn = getattr(_db_local, 'conn', None)
+        # Соединение нельзя использовать после fork() или при смене пути к базе
+        if conn is None or _db_local.path != path or _db_local.pid != os.getpid():
+            conn = connect_db(path)
+            _db_local.conn = conn
+            _db_local.path = path
+            _db_local.pid = os.getpid()
+        g.db = conn
+    return g.db
+
+@app.teardown_appcontext
+def release_db(exception):
+    """
+    Освобождает соединение по окончании запроса. Само соединение не закрывается,
+    а остается у потока; незавершенная транзакция (например, после ошибки) откатывается.
+    """
+    conn = g.pop('db', None)
+    if conn is not None and conn.in_transaction:
+        conn.rollback()
+
+def _add_missing_columns(c, table, columns):
+    """
+    Добавляет в таблицу колонки, которых в ней еще нет.
+    Нужна для старых файлов users.db, созданных до появления этих колонок.
+    """
+    existing = {row[1] for row in c.execute(f"PRAGMA table_info({table})")}
+    for name, declaration in columns:
+        if name not in existing:
+            c.execute(f"ALTER TABLE {table} ADD COLUMN {name} {declaration}")
 
-    # Включаем поддержку внешних ключей для соединения (важно для SQLite для обеспечения целостности данных)
-    c.execute("PRAGMA foreign_keys = ON")
 
+def migrate_v1(c):
+    """
+    Миграция 1: базовая схема (users, listings, favorites).
+    Старые базы с неполной схемой дополняются недостающими колонками.
+    """
     # Создание таблицы 'users' для хранения информации о пользователях
     # Поля: id (первичный ключ), username (уникальный), password (хешированный),
     # role (роль пользователя, по умолчанию 1 - обычный пользователь),
@@ -83,9 +289,293 @@ def init_db():
             FOREIGN KEY (listing_id) REFERENCES listings(id) ON DELETE CASCADE
         )
     ''')
-    
-    # Сохраняем изменения в базе данных
-    conn.commit()
+    # Старые версии схемы: у users не было профиля, у listings - типа сделки,
+    # типа жилья, телефона и владельца (тип сделки хранился в колонке 'type')
+    _add_missing_columns(c, 'users', [
+        ('display_name', 'TEXT'),
+        ('profile_image', 'TEXT'),
+    ])
+    _add_missing_columns(c, 'listings', [
+        ('deal_type', 'TEXT'),
+        ('housing_type', 'TEXT'),
+        ('phone', 'TEXT'),
+        ('user_id', 'INTEGER REFERENCES users(id) ON DELETE SET NULL'),
+    ])
+    legacy_columns = {row[1] for row in c.execute("PRAGMA table_info(listings)")}
+    if 'type' in legacy_columns:
+        c.execute('''
+            UPDATE listings
+            SET deal_type = CASE type WHEN 'sell' THEN 'sale' ELSE type END
+            WHERE deal_type IS NULL
+        ''')
+
+
+def migrate_v2(c):
+    """
+    Миграция 2: индексы под реальные запросы страниц.
+    """
+    # Фильтры /rent и /sale: равенство по deal_type, city, housing_type, rooms и диапазон по price
+    c.execute('''
+        CREATE INDEX IF NOT EXISTS idx_listings_filter
+        ON listings (deal_type, city, housing_type, rooms, price)
+    ''')
+    # Фильтр только по цене (без города) внутри типа сделки
+    c.execute('CREATE INDEX IF NOT EXISTS idx_listings_deal_price ON listings (deal_type, price)')
+    # Объявления пользователя в профиле и ON DELETE SET NULL при удалении пользователя
+    c.execute('CREATE INDEX IF NOT EXISTS idx_listings_user ON listings (user_id)')
+    # Избранное по пользователю уже покрыто индексом UNIQUE(user_id, listing_id);
+    # обратный индекс нужен для ON DELETE CASCADE при удалении объявления
+    c.execute('CREATE INDEX IF NOT EXISTS idx_favorites_listing ON favorites (listing_id)')
+
+
+def migrate_v3(c):
+    """
+    Миграция 3: индекс для постраничного вывода новых объявлений (ORDER BY id) по типу сделки.
+    """
+    c.execute('CREATE INDEX IF NOT EXISTS idx_listings_deal_id ON listings (deal_type, id)')
+
+
+def migrate_v4(c):
+    """
+    Миграция 4: полнотекстовый индекс FTS5 по описанию, деталям и городу объявлений.
+    Индекс хранит только ссылки на строки listings (external content) и
+    поддерживается в актуальном состоянии триггерами.
+    """
+    c.execute('''
+        CREATE VIRTUAL TABLE IF NOT EXISTS listings_fts USING fts5(
+            description, details, city,
+            content='listings', content_rowid='id',
+            tokenize='unicode61 remove_diacritics 2'
+        )
+    ''')
+    c.execute('''
+        CREATE TRIGGER IF NOT EXISTS listings_fts_insert AFTER INSERT ON listings BEGIN
+            INSERT INTO listings_fts (rowid, description, details, city)
+            VALUES (new.id, new.description, new.details, new.city);
+        END
+    ''')
+    c.execute('''
+        CREATE TRIGGER IF NOT EXISTS listings_fts_delete AFTER DELETE ON listings BEGIN
+            INSERT INTO listings_fts (listings_fts, rowid, description, details, city)
+            VALUES ('delete', old.id, old.description, old.details, old.city);
+        END
+    ''')
+    c.execute('''
+        CREATE TRIGGER IF NOT EXISTS listings_fts_update AFTER UPDATE OF description, details, city ON listings BEGIN
+            INSERT INTO listings_fts (listings_fts, rowid, description, details, city)
+            VALUES ('delete', old.id, old.description, old.details, old.city);
+            INSERT INTO listings_fts (rowid, description, details, city)
+            VALUES (new.id, new.description, new.details, new.city);
+        END
+    ''')
+    # Индексируем уже существующие объявления
+    c.execute("INSERT INTO listings_fts (listings_fts) VALUES ('rebuild')")
+
+
+def migrate_v5(c):
+    """
+    Миграция 5: таблица служебных счетчиков (версия данных объявлений для сброса кэшей).
+    """
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS app_state (
+            key TEXT PRIMARY KEY,
+            value INTEGER NOT NULL DEFAULT 0
+        ) WITHOUT ROWID
+    ''')
+    c.execute("INSERT OR IGNORE INTO app_state (key, value) VALUES ('listings_version', 0)")
+
+
+def migrate_v6(c):
+    """
+    Миграция 6: пути к уменьшенным копиям фотографий объявлений и профилей (JSON).
+    """
+    _add_missing_columns(c, 'listings', [('image_variants', 'TEXT')])
+    _add_missing_columns(c, 'users', [('profile_image_variants', 'TEXT')])
+
+
+def migrate_v7(c):
+    """
+    Миграция 7: учет загруженных файлов (адресация по хешу содержимого) и ссылок на них.
+    Счетчик ссылок refcount ведут триггеры на listings.image и users.profile_image.
+    """
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS uploads (
+            hash TEXT PRIMARY KEY,          -- SHA-256 содержимого файла
+            url TEXT NOT NULL UNIQUE,       -- /static/uploads/ab/<hash>.<ext>
+            size INTEGER NOT NULL,          -- размер в байтах
+            refcount INTEGER NOT NULL DEFAULT 0,
+            created_at INTEGER NOT NULL     -- время загрузки (unix time)
+        )
+    ''')
+    # Быстрый поиск файлов, на которые больше нет ссылок
+    c.execute('CREATE INDEX IF NOT EXISTS idx_uploads_unreferenced ON uploads (hash) WHERE refcount <= 0')
+    for table, column in (('listings', 'image'), ('users', 'profile_image')):
+        c.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS uploads_ref_{table}_insert
+            AFTER INSERT ON {table} WHEN new.{column} IS NOT NULL BEGIN
+                UPDATE uploads SET refcount = refcount + 1 WHERE url = new.{column};
+            END
+        ''')
+        c.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS uploads_ref_{table}_delete
+            AFTER DELETE ON {table} WHEN old.{column} IS NOT NULL BEGIN
+                UPDATE uploads SET refcount = refcount - 1 WHERE url = old.{column};
+            END
+        ''')
+        c.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS uploads_ref_{table}_update
+            AFTER UPDATE OF {column} ON {table} WHEN old.{column} IS NOT new.{column} BEGIN
+                UPDATE uploads SET refcount = refcount - 1 WHERE url = old.{column};
+                UPDATE uploads SET refcount = refcount + 1 WHERE url = new.{column};
+            END
+        ''')
+
+def migrate_v8(c):
+    """
+    Миграция 8: номера ревизий объявлений и профилей для ETag.
+    Ревизию увеличивают триггеры при любом изменении объявления и при изменении
+    данных профиля, которые видны на странице объявления (имя и фото).
+    """
+    _add_missing_columns(c, 'listings', [('revision', 'INTEGER NOT NULL DEFAULT 1')])
+    _add_missing_columns(c, 'users', [('revision', 'INTEGER NOT NULL DEFAULT 1')])
+    c.execute('''
+        CREATE TRIGGER IF NOT EXISTS listings_revision_update
+        AFTER UPDATE ON listings WHEN new.revision = old.revision BEGIN
+            UPDATE listings SET revision = old.revision + 1 WHERE id = new.id;
+        END
+    ''')
+    c.execute('''
+        CREATE TRIGGER IF NOT EXISTS users_revision_update
+        AFTER UPDATE OF display_name, profile_image, profile_image_variants ON users
+        WHEN new.revision = old.revision BEGIN
+            UPDATE users SET revision = old.revision + 1 WHERE id = new.id;
+        END
+    ''')
+
+def migrate_v9(c):
+    """
+    Миграция 9: координаты объявлений и пространственный индекс R*Tree по ним.
+    listings_geo заполняют триггеры; объявления без координат в индекс не попадают.
+    """
+    _add_missing_columns(c, 'listings', [('latitude', 'REAL'), ('longitude', 'REAL')])
+    c.execute('''
+        CREATE VIRTUAL TABLE IF NOT EXISTS listings_geo
+        USING rtree(id, min_lat, max_lat, min_lon, max_lon)
+    ''')
+    c.execute('''
+        CREATE TRIGGER IF NOT EXISTS listings_geo_insert
+        AFTER INSERT ON listings
+        WHEN new.latitude IS NOT NULL AND new.longitude IS NOT NULL BEGIN
+            INSERT INTO listings_geo VALUES (new.id, new.latitude, new.latitude, new.longitude, new.longitude);
+        END
+    ''')
+    c.execute('''
+        CREATE TRIGGER IF NOT EXISTS listings_geo_delete
+        AFTER DELETE ON listings BEGIN
+            DELETE FROM listings_geo WHERE id = old.id;
+        END
+    ''')
+    c.execute('''
+        CREATE TRIGGER IF NOT EXISTS listings_geo_update
+        AFTER UPDATE OF latitude, longitude ON listings BEGIN
+            DELETE FROM listings_geo WHERE id = old.id;
+            INSERT INTO listings_geo
+            SELECT new.id, new.latitude, new.latitude, new.longitude, new.longitude
+            WHERE new.latitude IS NOT NULL AND new.longitude IS NOT NULL;
+        END
+    ''')
+    c.execute('''
+        INSERT OR REPLACE INTO listings_geo
+        SELECT id, latitude, latitude, longitude, longitude FROM listings
+        WHERE latitude IS NOT NULL AND longitude IS NOT NULL
+    ''')
+
+def migrate_v10(c):
+    """
+    Миграция 10: ревизия избранного пользователя. Ее увеличивают триггеры
+    при добавлении и удалении избранного (в том числе каскадном при удалении объявления);
+    по ней проверяются кэш избранного и ETag страниц с отметками избранного.
+    """
+    _add_missing_columns(c, 'users', [('favorites_revision', 'INTEGER NOT NULL DEFAULT 0')])
+    c.execute('''
+        CREATE TRIGGER IF NOT EXISTS favorites_revision_insert
+        AFTER INSERT ON favorites BEGIN
+            UPDATE users SET favorites_revision = favorites_revision + 1 WHERE id = new.user_id;
+        END
+    ''')
+    c.execute('''
+        CREATE TRIGGER IF NOT EXISTS favorites_revision_delete
+        AFTER DELETE ON favorites BEGIN
+            UPDATE users SET favorites_revision = favorites_revision + 1 WHERE id = old.user_id;
+        END
+    ''')
+
+def migrate_v11(c):
+    """
+    Миграция 11: индекс для сортировки всех объявлений по цене в админке
+    (без фильтра по типу сделки индекс idx_listings_deal_price не подходит).
+    """
+    c.execute('CREATE INDEX IF NOT EXISTS idx_listings_price ON listings (price)')
+
+def migrate_v12(c):
+    """
+    Миграция 12: индексы по путям фотографий - для проверки ссылок на файлы
+    при сборке мусора в папке загрузок (объявления и профили без фото в индекс не попадают).
+    """
+    c.execute('CREATE INDEX IF NOT EXISTS idx_listings_image ON listings (image) WHERE image IS NOT NULL')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_users_profile_image ON users (profile_image) WHERE profile_image IS NOT NULL')
+
+
+# Список миграций по порядку; версия схемы (PRAGMA user_version)
+# равна количеству уже примененных миграций
+MIGRATIONS = [
+    migrate_v1,
+    migrate_v2,
+    migrate_v3,
+    migrate_v4,
+    migrate_v5,
+    migrate_v6,
+    migrate_v7,
+    migrate_v8,
+    migrate_v9,
+    migrate_v10,
+    migrate_v11,
+    migrate_v12,
+]
+
+
+def migrate_db(conn):
+    """
+    Применяет к базе недостающие миграции и возвращает итоговую версию схемы.
+    Каждая миграция выполняется в своей транзакции вместе с обновлением user_version;
+    BEGIN IMMEDIATE не дает двум процессам применить одну миграцию дважды.
+    """
+    while True:
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            version = conn.execute('PRAGMA user_version').fetchone()[0]
+            if version >= len(MIGRATIONS):
+                conn.commit()
+                return version
+            MIGRATIONS[version](conn.cursor())
+            conn.execute(f'PRAGMA user_version = {version + 1}')
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+
+
+def init_db():
+    """
+    Инициализирует базу данных: создает таблицы и обновляет схему существующего файла
+    до последней версии миграций.
+    """
+    # Устанавливаем соединение с файлом базы данных из конфигурации приложения
+    # (внешние ключи и остальные PRAGMA включаются в connect_db)
+    conn = connect_db()
+    migrate_db(conn)
+    # Обновляем статистику планировщика запросов после изменения индексов
+    conn.execute('PRAGMA optimize')
     # Закрываем соединение с базой данных
     conn.close()
 
@@ -114,6 +604,16 @@ def login_required(f):
         return f(*args, **kwargs)  # Выполнение исходной функции, если пользователь аутентифицирован
     return decorated
 
+@app.errorhandler(RequestEntityTooLarge)
+def request_too_large(error):
+    """
+    Слишком большой запрос (файл больше MAX_CONTENT_LENGTH): тело не читается,
+    пользователь возвращается на предыдущую страницу с сообщением.
+    """
+    limit = app.config['MAX_CONTENT_LENGTH'] // (1024 * 1024)
+    flash(f'Файл слишком большой (не более {limit} МБ).', 'danger')
+    return redirect(request.referrer or url_for('rent'))
+
 def allowed_file(filename):
     """
     Проверяет, имеет ли загружаемый файл разрешенное расширение.
@@ -122,455 +622,1866 @@ def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in app.config['ALLOWED_EXTENSIONS']
 
 
-# ---------- ОБЪЯВЛЕНИЯ ----------
-# Маршруты и функции, связанные с отображением, добавлением и управлением объявлениями.
+# ---------- МЕТРИКИ ----------
+# Время обработки запросов, количество и время SQL-запросов, время отрисовки шаблонов
+# и хеширования паролей. Метрики хранятся в памяти процесса и отдаются на /admin/metrics
+# в текстовом формате Prometheus; медленные SQL-запросы пишутся в журнал приложения.
 
-@app.route('/rent', methods=['GET', 'POST'])
-def rent():
+# Границы корзин гистограмм времени (в секундах)
+DURATION_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# Границы корзин гистограммы количества SQL-запросов на один HTTP-запрос
+QUERY_COUNT_BUCKETS = (1, 2, 3, 5, 10, 20, 50, 100)
+
+
+class Metrics:
     """
-    Отображает страницу с объявлениями об аренде.
-    Позволяет фильтровать объявления по цене, количеству комнат, городу и типу жилья.
+    Потокобезопасный реестр счетчиков и гистограмм с метками.
     """
-    # Устанавливаем соединение с базой данных
-    conn = sqlite3.connect('users.db')
-    # Устанавливаем row_factory для доступа к данным по именам колонок
-    conn.row_factory = sqlite3.Row
-    c = conn.cursor()
 
-    # Базовый SQL-запрос для выборки объявлений об аренде
-    query = "SELECT * FROM listings WHERE deal_type = 'rent'"
-    filters = []  # Список для хранения условий фильтрации
-    values = []   # Список для хранения значений для SQL-запроса
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._help = {}        # имя -> (тип, описание)
+        self._counters = {}    # (имя, метки) -> значение
+        self._histograms = {}  # (имя, метки) -> [счетчики корзин, сумма, количество]
+        self._buckets = {}     # имя гистограммы -> границы корзин
+
+    def counter(self, name, description):
+        self._help[name] = ('counter', description)
+
+    def histogram(self, name, description, buckets=DURATION_BUCKETS):
+        self._help[name] = ('histogram', description)
+        self._buckets[name] = buckets
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        buckets = self._buckets[name]
+        with self._lock:
+            entry = self._histograms.get(key)
+            if entry is None:
+                entry = self._histograms[key] = [[0] * len(buckets), 0.0, 0]
+            for i, bound in enumerate(buckets):
+                if value <= bound:
+                    entry[0][i] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    def render(self, gauges=(), counters=()):
+        """
+        Текст в формате Prometheus. gauges и counters - дополнительные значения
+        (имя, описание, значение), которые считаются вне реестра: текущие и только растущие.
+        """
+        lines = []
+        with self._lock:
+            registered = sorted(self._counters.items())
+            histograms = sorted(self._histograms.items())
+        for name, (kind, description) in sorted(self._help.items()):
+            lines.append(f'# HELP {name} {description}')
+            lines.append(f'# TYPE {name} {kind}')
+            if kind == 'counter':
+                for (metric, labels), value in registered:
+                    if metric == name:
+                        lines.append(f'{name}{_format_labels(labels)} {value}')
+                continue
+            for (metric, labels), (counts, total, count) in histograms:
+                if metric != name:
+                    continue
+                for bound, value in zip(self._buckets[name], counts):
+                    lines.append(f'{name}_bucket{_format_labels(labels + (("le", repr(float(bound))),))} {value}')
+                lines.append(f'{name}_bucket{_format_labels(labels + (("le", "+Inf"),))} {count}')
+                lines.append(f'{name}_sum{_format_labels(labels)} {total}')
+                lines.append(f'{name}_count{_format_labels(labels)} {count}')
+        for kind, extra in (('gauge', gauges), ('counter', counters)):
+            for name, description, value in extra:
+                lines.append(f'# HELP {name} {description}')
+                lines.append(f'# TYPE {name} {kind}')
+                lines.append(f'{name} {value}')
+        return '\n'.join(lines) + '\n'
+
+
+def _format_labels(labels):
+    """
+    Метки в формате Prometheus: {endpoint="rent",status="200"} (пустая строка без меток).
+    """
+    if not labels:
+        return ''
+    escape = lambda value: str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    return '{' + ','.join(f'{key}="{escape(value)}"' for key, value in labels) + '}'
 
-    # Инициализация переменных для сохранения значений фильтров (чтобы передать их обратно в шаблон)
-    housing_type = ''
-    rooms = ''
 
-    # Если запрос методом POST (т.е. пользователь применил фильтры)
-    if request.method == 'POST':
-        # Получаем значения фильтров из формы
-        min_price = request.form.get('min_price')
-        max_price = request.form.get('max_price')
-        rooms = request.form.get('rooms')
-        city = request.form.get('city')
-        housing_type = request.form.get('housing_type')
-
-        # Добавляем условия в запрос в зависимости от заполненных полей фильтра
-        if min_price:
-            filters.append("price >= ?")
-            values.append(int(min_price))
-        if max_price:
-            filters.append("price <= ?")
-            values.append(int(max_price))
-        if housing_type:
-            filters.append("housing_type = ?")
-            values.append(housing_type)
-            # Если выбран тип жилья "комната", то фильтр по количеству комнат игнорируется
-            if housing_type == 'комната':
-                rooms = '' # Сбрасываем значение rooms, чтобы оно не учитывалось
-        if rooms and rooms.isdigit(): # Проверяем, что rooms указано и является числом
-            filters.append("rooms = ?")
-            values.append(int(rooms))
-        if city:
-            filters.append("city = ?")
-            values.append(city)
-             # Если выбрана "комната" — фильтруем только по housing_type, rooms игнорируем
-        if housing_type != 'комната' and rooms: # Если не комната и указано количество комнат
-            filters.append("rooms = ?")
-            values.append(int(rooms))
-
-
-    # Если есть активные фильтры, добавляем их к SQL-запросу
-    if filters:
-        query += " AND " + " AND ".join(filters)
-
-    # Выполняем SQL-запрос с параметрами
-    c.execute(query, values)
-    listings = c.fetchall()  # Получаем все отфильтрованные объявления
-    conn.close()  # Закрываем соединение с базой данных
-
-    # Отображаем шаблон 'rent.html', передавая список объявлений и текущие значения фильтров
-    return render_template('rent.html', listings=listings, housing_type=housing_type, rooms=rooms)
+metrics = Metrics()
+metrics.counter('http_requests_total', 'Количество HTTP-запросов')
+metrics.histogram('http_request_duration_seconds', 'Время обработки HTTP-запроса')
+metrics.histogram('http_request_sql_queries', 'Количество SQL-запросов на один HTTP-запрос', QUERY_COUNT_BUCKETS)
+metrics.histogram('http_request_sql_seconds', 'Суммарное время SQL-запросов одного HTTP-запроса')
+metrics.counter('sql_queries_total', 'Количество SQL-запросов')
+metrics.counter('sql_slow_queries_total', 'Количество медленных SQL-запросов (дольше SLOW_QUERY_MS)')
+metrics.histogram('template_render_seconds', 'Время отрисовки шаблона')
+metrics.histogram('password_hash_seconds', 'Время хеширования и проверки паролей')
 
 
-@app.route('/sale', methods=['GET', 'POST'])
-def sale():
+def _current_endpoint():
+    return (request.endpoint or 'unknown') if has_request_context() else 'none'
+
+
+class InstrumentedCursor(sqlite3.Cursor):
     """
-    Отображает страницу с объявлениями о продаже.
-    Позволяет фильтровать объявления по цене, количеству комнат и городу.
+    Курсор, который замеряет время каждого SQL-запроса.
+    Время и количество запросов накапливаются в g для текущего HTTP-запроса;
+    запросы дольше SLOW_QUERY_MS пишутся в журнал вместе с параметрами.
     """
-    # Аналогично функции rent(), но для объявлений о продаже
-    conn = sqlite3.connect('users.db')
-    conn.row_factory = sqlite3.Row
-    c = conn.cursor()
 
-    # Базовый SQL-запрос для выборки объявлений о продаже
-    query = "SELECT * FROM listings WHERE deal_type  = 'sale'"
-    filters = []
-    values = []
+    def execute(self, sql, parameters=()):
+        started = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            _record_query(sql, parameters, time.perf_counter() - started)
 
-    if request.method == 'POST':
-        min_price = request.form.get('min_price')
-        max_price = request.form.get('max_price')
-        rooms = request.form.get('rooms')
-        city = request.form.get('city')
-
-        if min_price:
-            filters.append("price >= ?")
-            values.append(int(min_price))
-        if max_price:
-            filters.append("price <= ?")
-            values.append(int(max_price))
-        if rooms:
-            filters.append("rooms = ?")
-            values.append(int(rooms))
-        if city:
-            filters.append("city = ?")
-            values.append(city)
-        
-    if filters:
-        query += " AND " + " AND ".join(filters)
-
-    c.execute(query, values)
-    listings = c.fetchall()
-    conn.close()
+    def executemany(self, sql, seq_of_parameters):
+        started = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            _record_query(sql, None, time.perf_counter() - started)
 
-    return render_template('sale.html', listings=listings)
 
-@app.route('/add', methods=['GET', 'POST'])
-@login_required  # Доступ только для аутентифицированных пользователей
-def add_listing():
+class InstrumentedConnection(sqlite3.Connection):
     """
-    Обрабатывает добавление нового объявления.
-    При GET-запросе отображает форму добавления.
-    При POST-запросе сохраняет данные нового объявления в базу данных.
+    Соединение, все курсоры которого (в том числе у conn.execute()) - InstrumentedCursor.
     """
-    if request.method == 'POST':
-        # Обработка загрузки изображения
-        image = None
-        if 'image' in request.files:
-            file = request.files['image']
-            # Если файл выбран и имеет разрешенное расширение
-            if file and allowed_file(file.filename):
-                filename = secure_filename(file.filename)  # Безопасное имя файла
-                file_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-                file.save(file_path)  # Сохранение файла
-                image = f"/static/uploads/{filename}"  # Путь к файлу для сохранения в БД
-
-        # Получение данных из формы
-        price = int(request.form['price'])
-        housing_type = request.form.get('housing_type', '') # Тип жилья
-
-        # Если тип жилья "комната", количество комнат устанавливается в 1
-        if housing_type == 'комната':
-            rooms = 1
-        else:
-            rooms_raw = request.form.get('rooms')
-            try:
-                # Преобразование количества комнат в целое число, если оно указано
-                rooms = int(rooms_raw) if rooms_raw else 0
-            except ValueError:
-                rooms = 0 # Если не удалось преобразовать, считаем 0 комнат
-        
-        description = request.form['description']
-        details = request.form['details']
-        housing_type_form = request.form['housing_type'] # Повторное получение, возможно для другой логики (переменная housing_type уже есть)
-        deal_type = request.form['deal_type']
-        city = request.form['city']
-        area = int(request.form['area'])
-        phone = request.form['phone']
-        user_id = session.get('user_id') # ID текущего пользователя из сессии
-
-        # Получение координат с карты (если они переданы)
-        latitude = request.form.get('latitude')
-        longitude = request.form.get('longitude')
-
-        # Попытка преобразовать координаты в float
-        try:
-            latitude = float(latitude) if latitude else None
-            longitude = float(longitude) if longitude else None
-        except ValueError:
-            latitude = None
-            longitude = None
 
-        # Повторная логика установки количества комнат для "комнаты"
-        if housing_type_form == 'комната': # Используется housing_type_form
-            rooms = 1
-        else:
-            rooms = int(request.form['rooms']) # Прямое преобразование из формы
+    def cursor(self, factory=InstrumentedCursor):
+        return super().cursor(factory)
 
-        # Сохранение объявления в базу данных
-        conn = sqlite3.connect('users.db')
-        c = conn.cursor()
-        c.execute('''
-            INSERT INTO listings 
-            (image, price, rooms, description, details, deal_type, housing_type, city, area, phone, user_id)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-        ''', (image, price, rooms, description, details, deal_type, housing_type_form, city, area, phone, user_id))
-        conn.commit()
-        conn.close()
+    # Встроенные conn.execute() и conn.executemany() вызывают курсор в обход его методов
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
 
-        flash("Объявление добавлено!")  # Сообщение об успехе
-        return redirect(url_for('profile'))  # Перенаправление на страницу профиля
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
 
-    # Если метод GET, отображаем форму добавления объявления
-    return render_template('add_listing.html')
+
+def _redact_parameters(parameters):
+    """
+    Скрывает хеши паролей в параметрах запроса перед записью в журнал.
+    """
+    hidden = lambda value: isinstance(value, str) and value.startswith(('scrypt:', 'pbkdf2:'))
+    if isinstance(parameters, dict):
+        return {key: '***' if hidden(value) else value for key, value in parameters.items()}
+    return ['***' if hidden(value) else value for value in parameters]
 
 
-@app.route('/listing/<int:listing_id>')
-def listing_detail(listing_id):
+def _record_query(sql, parameters, elapsed):
+    endpoint = _current_endpoint()
+    metrics.inc('sql_queries_total', endpoint=endpoint)
+    if has_request_context():
+        g.sql_queries = g.get('sql_queries', 0) + 1
+        g.sql_seconds = g.get('sql_seconds', 0.0) + elapsed
+    if elapsed * 1000 >= app.config['SLOW_QUERY_MS']:
+        metrics.inc('sql_slow_queries_total', endpoint=endpoint)
+        params = repr(_redact_parameters(parameters)) if parameters is not None else '(executemany)'
+        app.logger.warning('Медленный SQL-запрос (%.1f мс, %s): %s; параметры: %.500s',
+                           elapsed * 1000, endpoint, ' '.join(sql.split()), params)
+
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+
+@app.after_request
+def record_request_metrics(response):
     """
-    Отображает детальную информацию о конкретном объявлении.
-    Включает информацию о продавце (display_name, profile_image).
+    Записывает метрики запроса и добавляет заголовок Server-Timing
+    (время SQL, шаблонов и всего запроса видно в инструментах разработчика браузера).
+    Потоковый ответ (/rent, /sale) еще не отрисован, когда отправляются заголовки:
+    его метрики записываются после отправки всего тела (call_on_close), а Server-Timing
+    показывает то, что известно к первому байту (ttfb вместо total).
     """
-    conn = sqlite3.connect('users.db')
-    conn.row_factory = sqlite3.Row
-    c = conn.cursor()
+    started = g.get('request_started')
+    if started is None:
+        return response
+    endpoint = request.endpoint or 'unknown'
+    method = request.method
+    # Объект g этого запроса: при потоковой отрисовке в него же попадают время SQL и шаблона
+    request_g = g._get_current_object()
+
+    def record():
+        elapsed = time.perf_counter() - started
+        metrics.inc('http_requests_total', endpoint=endpoint, method=method, status=response.status_code)
+        metrics.observe('http_request_duration_seconds', elapsed, endpoint=endpoint)
+        metrics.observe('http_request_sql_queries', request_g.get('sql_queries', 0), endpoint=endpoint)
+        metrics.observe('http_request_sql_seconds', request_g.get('sql_seconds', 0.0), endpoint=endpoint)
+
+    elapsed = time.perf_counter() - started
+    if response.is_streamed:
+        response.call_on_close(record)
+    else:
+        record()
+    response.headers['Server-Timing'] = (
+        f"db;desc=\"{g.get('sql_queries', 0)} SQL\";dur={g.get('sql_seconds', 0.0) * 1000:.1f}, "
+        f"tpl;dur={g.get('template_seconds', 0.0) * 1000:.1f}, "
+        f"{'ttfb' if response.is_streamed else 'total'};dur={elapsed * 1000:.1f}")
+    return response
 
-    # SQL-запрос для получения данных объявления и информации о пользователе, его разместившем
-    c.execute('''
-        SELECT l.*, u.display_name, u.profile_image
-        FROM listings l
-        LEFT JOIN users u ON l.user_id = u.id
-        WHERE l.id = ?
-    ''', (listing_id,))
-    listing = c.fetchone()  # Получаем одно объявление
-    conn.close()
 
-    # Если объявление не найдено, показываем сообщение и перенаправляем
-    if not listing:
-        flash("Объявление не найдено.", "danger")
-        return redirect(url_for('rent'))
+@before_render_template.connect_via(app)
+def _template_started(sender, template, context, **extra):
+    g.template_started = time.perf_counter()
 
-    # Отображаем шаблон с деталями объявления
-    return render_template('listing_detail.html', listing=listing)
 
+@template_rendered.connect_via(app)
+def _template_finished(sender, template, context, **extra):
+    started = g.pop('template_started', None)
+    if started is not None:
+        elapsed = time.perf_counter() - started
+        g.template_seconds = g.get('template_seconds', 0.0) + elapsed
+        metrics.observe('template_render_seconds', elapsed, template=template.name)
 
-# ---------- ИЗБРАННОЕ ----------
-# Маршруты и функции для управления списком избранных объявлений пользователя.
 
-<<<<<<< Updated upstream
-@app.route('/admin', methods=['GET', 'POST'])
-@login_required
-def admin():
-<<<<<<< Updated upstream
-=======
-=======
+@app.route('/admin/metrics')
+def admin_metrics():
+    """
+    Метрики в текстовом формате Prometheus.
+    Доступны администратору (по сессии) или сборщику метрик с заголовком
+    "Authorization: Bearer <METRICS_TOKEN>", если токен задан в настройках.
+    Метрики относятся к текущему процессу.
+    """
+    token = app.config['METRICS_TOKEN']
+    authorized = session.get('role') == 0 or (
+        token and hmac.compare_digest(request.headers.get('Authorization', ''), f'Bearer {token}'))
+    if not authorized:
+        abort(403)
+
+    cache = listings_cache.stats()
+    cards = card_cache.stats()
+    gauges = [
+        ('listings_cache_size', 'Записей в кэше результатов поиска', cache['size']),
+        ('listings_cache_hit_ratio', 'Доля попаданий в кэш результатов поиска', cache['hit_rate']),
+        ('card_cache_size', 'Карточек объявлений в кэше', cards['size']),
+        ('card_cache_hit_ratio', 'Доля попаданий в кэш карточек объявлений', cards['hit_rate']),
+    ]
+    counters = [
+        ('listings_cache_hits_total', 'Попаданий в кэш результатов поиска', cache['hits']),
+        ('listings_cache_misses_total', 'Промахов кэша результатов поиска', cache['misses']),
+        ('listings_cache_invalidations_total', 'Сбросов кэша результатов поиска', cache['invalidations']),
+    ]
+    return app.response_class(metrics.render(gauges, counters), mimetype='text/plain; version=0.0.4')
+
+
+# ---------- ПАРОЛИ ----------
+# Хеширование и проверка паролей намеренно дорогие по CPU. Чтобы вход и регистрация
+# не занимали потоки, обслуживающие страницы, они выполняются в отдельных процессах
+# (ограниченный пул); очередь ожидающих операций тоже ограничена.
+
+class PasswordHashBusy(Exception):
+    """
+    Пул хеширования паролей перегружен: очередь или вычисление хеша
+    дольше PASSWORD_HASH_TIMEOUT секунд. В запросе превращается в ответ 503.
+    """
 
-# ---------- ОБЪЯВЛЕНИЯ ----------
-# Маршруты и функции, связанные с отображением, добавлением и управлением объявлениями.
 
-@app.route('/rent', methods=['GET', 'POST'])
-def rent():
+class PasswordHasher:
     """
-    Отображает страницу с объявлениями об аренде.
-    Позволяет фильтровать объявления по цене, количеству комнат, городу и типу жилья.
+    Пул процессов для хеширования паролей. Создается при первом использовании
+    в каждом процессе приложения (после fork() пул нужно создавать заново).
     """
-    # Устанавливаем соединение с базой данных
-    conn = sqlite3.connect('users.db')
-    # Устанавливаем row_factory для доступа к данным по именам колонок
-    conn.row_factory = sqlite3.Row
-    c = conn.cursor()
 
-    # Базовый SQL-запрос для выборки объявлений об аренде
-    query = "SELECT * FROM listings WHERE deal_type = 'rent'"
-    filters = []  # Список для хранения условий фильтрации
-    values = []   # Список для хранения значений для SQL-запроса
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pool = None
+        self._pid = None
+        self._slots = None
+
+    def _get_pool(self):
+        with self._lock:
+            if self._pool is None or self._pid != os.getpid():
+                workers = app.config['PASSWORD_HASH_WORKERS']
+                # spawn: рабочие процессы не наследуют потоки и соединения с базой родительского процесса.
+                # Кроме модуля с функцией (werkzeug.security) spawn заново импортирует главный модуль
+                # процесса: при flask serve или WSGI-сервере это короткий скрипт запуска, а при
+                # python server.py - все приложение, поэтому в этом режиме пул не используется (см. ЗАПУСК)
+                self._pool = ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context('spawn'))
+                self._slots = threading.BoundedSemaphore(workers * app.config['PASSWORD_HASH_QUEUE'])
+                self._pid = os.getpid()
+            return self._pool, self._slots
+
+    def run(self, function, *args):
+        """
+        Выполняет function(*args) в пуле (или в текущем потоке, если PASSWORD_HASH_WORKERS = 0).
+        Если очередь заполнена дольше PASSWORD_HASH_TIMEOUT секунд, вызывает PasswordHashBusy.
+        """
+        if not app.config['PASSWORD_HASH_WORKERS']:
+            return function(*args)
+        pool, slots = self._get_pool()
+        timeout = app.config['PASSWORD_HASH_TIMEOUT']
+        if not slots.acquire(timeout=timeout):
+            raise PasswordHashBusy()
+        try:
+            return pool.submit(function, *args).result(timeout=timeout)
+        except FuturesTimeoutError:
+            raise PasswordHashBusy() from None
+        except BrokenProcessPool:
+            # Рабочий процесс аварийно завершился: пул пересоздается при следующем вызове
+            app.logger.exception('Пул хеширования паролей неработоспособен')
+            with self._lock:
+                if self._pool is pool:
+                    self._pool = None
+            return function(*args)
+        finally:
+            slots.release()
 
-    # Инициализация переменных для сохранения значений фильтров (чтобы передать их обратно в шаблон)
-    housing_type = ''
-    rooms = ''
 
-    # Если запрос методом POST (т.е. пользователь применил фильтры)
-    if request.method == 'POST':
-        # Получаем значения фильтров из формы
-        min_price = request.form.get('min_price')
-        max_price = request.form.get('max_price')
-        rooms = request.form.get('rooms')
-        city = request.form.get('city')
-        housing_type = request.form.get('housing_type')
-
-        # Добавляем условия в запрос в зависимости от заполненных полей фильтра
-        if min_price:
-            filters.append("price >= ?")
-            values.append(int(min_price))
-        if max_price:
-            filters.append("price <= ?")
-            values.append(int(max_price))
-        if housing_type:
-            filters.append("housing_type = ?")
-            values.append(housing_type)
-            # Если выбран тип жилья "комната", то фильтр по количеству комнат игнорируется
-            if housing_type == 'комната':
-                rooms = '' # Сбрасываем значение rooms, чтобы оно не учитывалось
-        if rooms and rooms.isdigit(): # Проверяем, что rooms указано и является числом
-            filters.append("rooms = ?")
-            values.append(int(rooms))
-        if city:
-            filters.append("city = ?")
-            values.append(city)
-             # Если выбрана "комната" — фильтруем только по housing_type, rooms игнорируем
-        if housing_type != 'комната' and rooms: # Если не комната и указано количество комнат
-            filters.append("rooms = ?")
-            values.append(int(rooms))
-
-
-    # Если есть активные фильтры, добавляем их к SQL-запросу
-    if filters:
-        query += " AND " + " AND ".join(filters)
-
-    # Выполняем SQL-запрос с параметрами
-    c.execute(query, values)
-    listings = c.fetchall()  # Получаем все отфильтрованные объявления
-    conn.close()  # Закрываем соединение с базой данных
-
-    # Отображаем шаблон 'rent.html', передавая список объявлений и текущие значения фильтров
-    return render_template('rent.html', listings=listings, housing_type=housing_type, rooms=rooms)
+password_hasher = PasswordHasher()
 
 
-@app.route('/sale', methods=['GET', 'POST'])
-def sale():
+@app.errorhandler(PasswordHashBusy)
+def password_hash_busy(error):
     """
-    Отображает страницу с объявлениями о продаже.
-    Позволяет фильтровать объявления по цене, количеству комнат и городу.
+    Пул хеширования паролей перегружен: запрос отклоняется с кодом 503.
     """
-    # Аналогично функции rent(), но для объявлений о продаже
-    conn = sqlite3.connect('users.db')
-    conn.row_factory = sqlite3.Row
-    c = conn.cursor()
+    return ServiceUnavailable().get_response()
 
-    # Базовый SQL-запрос для выборки объявлений о продаже
-    query = "SELECT * FROM listings WHERE deal_type  = 'sale'"
-    filters = []
-    values = []
 
-    if request.method == 'POST':
-        min_price = request.form.get('min_price')
-        max_price = request.form.get('max_price')
-        rooms = request.form.get('rooms')
-        city = request.form.get('city')
-
-        if min_price:
-            filters.append("price >= ?")
-            values.append(int(min_price))
-        if max_price:
-            filters.append("price <= ?")
-            values.append(int(max_price))
-        if rooms:
-            filters.append("rooms = ?")
-            values.append(int(rooms))
-        if city:
-            filters.append("city = ?")
-            values.append(city)
-        
-    if filters:
-        query += " AND " + " AND ".join(filters)
-
-    c.execute(query, values)
-    listings = c.fetchall()
-    conn.close()
+def hash_password(password):
+    """
+    Хеширует пароль методом PASSWORD_HASH_METHOD в пуле процессов (с замером времени для метрик).
+    """
+    started = time.perf_counter()
+    try:
+        return password_hasher.run(generate_password_hash, password, app.config['PASSWORD_HASH_METHOD'])
+    finally:
+        metrics.observe('password_hash_seconds', time.perf_counter() - started, operation='hash')
 
-    return render_template('sale.html', listings=listings)
 
-@app.route('/add', methods=['GET', 'POST'])
-@login_required  # Доступ только для аутентифицированных пользователей
-def add_listing():
+def verify_password(password_hash, password):
     """
-    Обрабатывает добавление нового объявления.
-    При GET-запросе отображает форму добавления.
-    При POST-запросе сохраняет данные нового объявления в базу данных.
+    Проверяет пароль по хешу в пуле процессов (с замером времени для метрик).
     """
-    if request.method == 'POST':
-        # Обработка загрузки изображения
-        image = None
-        if 'image' in request.files:
-            file = request.files['image']
-            # Если файл выбран и имеет разрешенное расширение
-            if file and allowed_file(file.filename):
-                filename = secure_filename(file.filename)  # Безопасное имя файла
-                file_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-                file.save(file_path)  # Сохранение файла
-                image = f"/static/uploads/{filename}"  # Путь к файлу для сохранения в БД
-
-        # Получение данных из формы
-        price = int(request.form['price'])
-        housing_type = request.form.get('housing_type', '') # Тип жилья
-
-        # Если тип жилья "комната", количество комнат устанавливается в 1
-        if housing_type == 'комната':
-            rooms = 1
-        else:
-            rooms_raw = request.form.get('rooms')
-            try:
-                # Преобразование количества комнат в целое число, если оно указано
-                rooms = int(rooms_raw) if rooms_raw else 0
-            except ValueError:
-                rooms = 0 # Если не удалось преобразовать, считаем 0 комнат
-        
-        description = request.form['description']
-        details = request.form['details']
-        housing_type_form = request.form['housing_type'] # Повторное получение, возможно для другой логики (переменная housing_type уже есть)
-        deal_type = request.form['deal_type']
-        city = request.form['city']
-        area = int(request.form['area'])
-        phone = request.form['phone']
-        user_id = session.get('user_id') # ID текущего пользователя из сессии
-
-        # Получение координат с карты (если они переданы)
-        latitude = request.form.get('latitude')
-        longitude = request.form.get('longitude')
-
-        # Попытка преобразовать координаты в float
-        try:
-            latitude = float(latitude) if latitude else None
-            longitude = float(longitude) if longitude else None
-        except ValueError:
-            latitude = None
-            longitude = None
-
-        # Повторная логика установки количества комнат для "комнаты"
-        if housing_type_form == 'комната': # Используется housing_type_form
-            rooms = 1
-        else:
-            rooms = int(request.form['rooms']) # Прямое преобразование из формы
+    started = time.perf_counter()
+    try:
+        return password_hasher.run(check_password_hash, password_hash, password)
+    finally:
+        metrics.observe('password_hash_seconds', time.perf_counter() - started, operation='verify')
 
-        # Сохранение объявления в базу данных
-        conn = sqlite3.connect('users.db')
-        c = conn.cursor()
-        c.execute('''
-            INSERT INTO listings 
-            (image, price, rooms, description, details, deal_type, housing_type, city, area, phone, user_id)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-        ''', (image, price, rooms, description, details, deal_type, housing_type_form, city, area, phone, user_id))
-        conn.commit()
-        conn.close()
 
-        flash("Объявление добавлено!")  # Сообщение об успехе
-        return redirect(url_for('profile'))  # Перенаправление на страницу профиля
+def password_needs_rehash(password_hash):
+    """
+    True, если хеш получен не текущим методом PASSWORD_HASH_METHOD (другой алгоритм или стоимость).
+    Хеш werkzeug имеет вид "метод$соль$хеш", например "scrypt:32768:8:1$...$...".
+    """
+    return password_hash.split('$', 1)[0] != app.config['PASSWORD_HASH_METHOD']
 
-    # Если метод GET, отображаем форму добавления объявления
-    return render_template('add_listing.html')
 
+# ---------- СТАТИЧЕСКИЕ ФАЙЛЫ ----------
+# Манифест CSS-файлов: при запуске каждый файл (или сборка из нескольких файлов)
+# минифицируется, получает имя с хешем содержимого и заранее сжимается gzip/brotli.
+# Такие файлы отдаются с Cache-Control: immutable - браузер не перепроверяет их,
+# а после изменения CSS у файла просто меняется имя.
 
-@app.route('/listing/<int:listing_id>')
-def listing_detail(listing_id):
+def minify_css(text):
     """
-    Отображает детальную информацию о конкретном объявлении.
-    Включает информацию о продавце (display_name, profile_image).
+    Простая минификация CSS: удаляет комментарии и лишние пробелы.
     """
-    conn = sqlite3.connect('users.db')
-    conn.row_factory = sqlite3.Row
-    c = conn.cursor()
+    text = re.sub(r'/\*.*?\*/', '', text, flags=re.S)
+    text = re.sub(r'\s+', ' ', text)
+    text = re.sub(r'\s*([{};,>])\s*', r'\1', text)
+    text = re.sub(r':\s+', ':', text)  # Пробел перед ':' не трогаем: в селекторе он значим
+    return text.replace(';}', '}').strip()
 
-    # SQL-запрос для получения данных объявления и информации о пользователе, его разместившем
-    c.execute('''
-        SELECT l.*, u.display_name, u.profile_image
+
+def build_asset_manifest():
+    """
+    Собирает манифест: логическое имя ('rent.css') -> запись с именем файла с хешем,
+    содержимым и его сжатыми копиями. Сборки из ASSET_BUNDLES склеиваются из нескольких файлов.
+    """
+    static_folder = app.static_folder
+    sources = {name: [name] for name in sorted(os.listdir(static_folder)) if name.endswith('.css')}
+    sources.update(app.config['ASSET_BUNDLES'])
+
+    manifest = {}
+    for name, parts in sources.items():
+        texts = []
+        for part in parts:
+            with open(os.path.join(static_folder, part), encoding='utf-8') as f:
+                texts.append(f.read())
+        text = '\n'.join(texts)
+        if app.config['ASSET_MINIFY']:
+            text = minify_css(text)
+        content = text.encode('utf-8')
+        digest = hashlib.sha256(content).hexdigest()[:12]
+        stem, extension = os.path.splitext(name)
+        entry = {
+            'filename': f'{stem}.{digest}{extension}',
+            'etag': digest,
+            'mimetype': 'text/css',
+            'identity': content,
+            'gzip': gzip.compress(content, compresslevel=9, mtime=0),
+        }
+        if brotli is not None:
+            entry['br'] = brotli.compress(content, quality=11)
+        manifest[name] = entry
+    return manifest
+
+
+# Манифест строится один раз при запуске; индекс по имени файла с хешем - для раздачи
+asset_manifest = build_asset_manifest()
+asset_files = {entry['filename']: entry for entry in asset_manifest.values()}
+
+
+@app.template_global()
+def asset_url(name):
+    """
+    Jinja-функция: URL CSS-файла с хешем содержимого в имени.
+    В режиме отладки (и для файлов не из манифеста) возвращает обычный URL /static,
+    чтобы правки CSS были видны без перезапуска.
+    """
+    entry = asset_manifest.get(name)
+    if entry is None or app.debug:
+        return url_for('static', filename=name)
+    return url_for('asset', filename=entry['filename'])
+
+
+@app.route('/assets/<filename>')
+def asset(filename):
+    """
+    Отдает CSS из манифеста. Если браузер поддерживает brotli или gzip,
+    отдается заранее сжатая копия.
+    """
+    entry = asset_files.get(filename)
+    if entry is None:
+        abort(404)
+
+    encoding = 'identity'
+    for candidate in ('br', 'gzip'):
+        if candidate in entry and request.accept_encodings[candidate]:
+            encoding = candidate
+            break
+
+    response = app.response_class(entry[encoding], mimetype=entry['mimetype'])
+    if encoding != 'identity':
+        response.headers['Content-Encoding'] = encoding
+    response.headers['Vary'] = 'Accept-Encoding'
+    response.headers['Cache-Control'] = f"public, max-age={app.config['ASSET_MAX_AGE']}, immutable"
+    response.set_etag(f"{entry['etag']}-{encoding}")
+    return response.make_conditional(request)
+
+
+# ---------- СЖАТИЕ ОТВЕТОВ ----------
+# HTML-страницы, JSON и выгрузки сжимаются gzip или brotli (что поддерживает браузер,
+# по заголовку Accept-Encoding). Потоковые ответы сжимаются по частям: каждая часть
+# сразу отправляется клиенту. Уже сжатые данные (фотографии, заранее сжатый CSS) не трогаются.
+
+def choose_encoding():
+    """
+    Выбирает сжатие для текущего запроса: 'br', 'gzip' или None.
+    Из поддерживаемых браузером выбирается с наибольшим приоритетом (q),
+    при равном приоритете - brotli.
+    """
+    accepted = request.accept_encodings
+    candidates = [('gzip', accepted['gzip'])]
+    if brotli is not None:
+        candidates.insert(0, ('br', accepted['br']))
+    encoding, quality = max(candidates, key=lambda candidate: candidate[1])
+    return encoding if quality > 0 else None
+
+
+def is_compressible(response):
+    """
+    Подходит ли ответ для сжатия: текстовый тип, еще не сжат и передается не напрямую из файла.
+    """
+    if response.status_code < 200 or response.status_code in (204, 206, 304):
+        return False
+    if 'Content-Encoding' in response.headers or response.direct_passthrough:
+        return False
+    if 'no-transform' in response.headers.get('Cache-Control', ''):
+        return False
+    return compressible_mimetype(response)
+
+
+def compressible_mimetype(response):
+    """
+    Текстовый ли тип у ответа (text/* или один из COMPRESS_MIMETYPES).
+    """
+    mimetype = response.mimetype or ''
+    return mimetype.startswith('text/') or mimetype in app.config['COMPRESS_MIMETYPES']
+
+
+def compress_body(data, encoding):
+    """
+    Сжимает тело ответа целиком.
+    """
+    if encoding == 'br':
+        return brotli.compress(data, quality=app.config['COMPRESS_BROTLI_QUALITY'])
+    return gzip.compress(data, compresslevel=app.config['COMPRESS_LEVEL'])
+
+
+def compress_stream(body, chunks, encoding):
+    """
+    Сжимает потоковый ответ по частям. После каждой части сжатые данные выталкиваются
+    (flush), поэтому клиент получает их сразу, а не после окончания ответа.
+    body - исходный объект ответа: его close() вызывается, даже если клиент отключился.
+    """
+    try:
+        if encoding == 'br':
+            compressor = brotli.Compressor(quality=app.config['COMPRESS_BROTLI_QUALITY'])
+            for chunk in chunks:
+                yield compressor.process(chunk) + compressor.flush()
+            yield compressor.finish()
+        else:
+            # wbits=16+MAX_WBITS - формат gzip (заголовок и контрольная сумма)
+            compressor = zlib.compressobj(app.config['COMPRESS_LEVEL'], zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+            for chunk in chunks:
+                yield compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)
+            yield compressor.flush()
+    finally:
+        if hasattr(body, 'close'):
+            body.close()
+
+
+@app.after_request
+def compress_response(response):
+    """
+    Сжимает подходящий ответ. Ответы меньше COMPRESS_MIN_SIZE байт отдаются как есть:
+    выигрыш от сжатия не окупает его стоимость.
+    """
+    if not app.config['COMPRESS_ENABLED']:
+        return response
+    if response.status_code == 304:
+        # 304 подтверждает сохраненный ответ 200: Vary у них должен совпадать, иначе
+        # кэш считает их разными вариантами. Тела нет, поэтому сжимать нечего
+        if not response.direct_passthrough and compressible_mimetype(response):
+            response.vary.add('Accept-Encoding')
+        return response
+    if not is_compressible(response):
+        return response
+    # Ответ на этот адрес зависит от Accept-Encoding, даже если именно этот не сжат
+    response.vary.add('Accept-Encoding')
+    encoding = choose_encoding()
+    if encoding is None:
+        return response
+
+    if response.is_streamed:
+        body = response.response
+        response.response = compress_stream(body, response.iter_encoded(), encoding)
+        response.headers.pop('Content-Length', None)
+    else:
+        data = response.get_data()
+        if len(data) < app.config['COMPRESS_MIN_SIZE']:
+            return response
+        response.set_data(compress_body(data, encoding))
+    response.headers['Content-Encoding'] = encoding
+    # Сжатое представление побайтно отличается от исходного: строгий ETag становится слабым
+    etag, weak = response.get_etag()
+    if etag and not weak:
+        response.set_etag(etag, weak=True)
+    return response
+
+
+# ---------- ЗАГРУЗКА ИЗОБРАЖЕНИЙ ----------
+# Хранение загруженных фотографий по хешу содержимого и подготовка уменьшенных копий (WebP и JPEG).
+# Одинаковые файлы хранятся один раз; таблица uploads считает ссылки на файл
+# из listings.image и users.profile_image (счетчик ведут триггеры), и файл
+# удаляется, когда ссылок на него не остается.
+
+# Размер блока при потоковой записи загрузки на диск
+UPLOAD_CHUNK_SIZE = 64 * 1024
+
+
+def upload_location(digest, extension):
+    """
+    Возвращает (путь на диске, URL) для файла с указанным хешем содержимого.
+    Файлы раскладываются по подпапкам по первым символам хеша, чтобы папки оставались небольшими.
+    """
+    relative = f"{digest[:2]}/{digest}.{extension}"
+    return os.path.join(app.config['UPLOAD_FOLDER'], *relative.split('/')), f"/static/uploads/{relative}"
+
+
+def upload_path_from_url(url):
+    """
+    Переводит URL загруженного файла (/static/uploads/...) в путь на диске.
+    """
+    relative = url[len('/static/uploads/'):]
+    return os.path.join(app.config['UPLOAD_FOLDER'], *relative.split('/'))
+
+
+def _stream_to_temp(file):
+    """
+    Потоково записывает загруженный файл во временный файл в папке загрузок,
+    одновременно вычисляя SHA-256. Возвращает (путь к временному файлу, хеш, размер).
+    """
+    os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
+    digest = hashlib.sha256()
+    size = 0
+    fd, temp_path = tempfile.mkstemp(dir=app.config['UPLOAD_FOLDER'], suffix='.part')
+    try:
+        with os.fdopen(fd, 'wb') as out:
+            while True:
+                chunk = file.stream.read(UPLOAD_CHUNK_SIZE)
+                if not chunk:
+                    break
+                digest.update(chunk)
+                out.write(chunk)
+                size += len(chunk)
+    except BaseException:
+        os.remove(temp_path)
+        raise
+    return temp_path, digest.hexdigest(), size
+
+
+def _place_upload(temp_path, path, url, variants):
+    """
+    Кладет файл по адресу его хеша (если его там еще нет) и создает недостающие копии.
+    Возвращает словарь вариантов изображения (см. make_image_variants).
+    """
+    if not os.path.exists(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        try:
+            os.link(temp_path, path)  # Жесткая ссылка: без копирования данных
+        except OSError:
+            shutil.copyfile(temp_path, path)
+    return make_image_variants(path, url, variants)
+
+
+def store_upload(conn, file, variants):
+    """
+    Сохраняет загруженное изображение с дедупликацией по SHA-256 содержимого.
+    Регистрирует файл в таблице uploads в текущей транзакции conn; ссылка на файл
+    засчитывается, когда URL записывается в listings.image или users.profile_image
+    в этой же транзакции.
+    Возвращает (URL файла, JSON с вариантами изображения или None).
+    """
+    extension = file.filename.rsplit('.', 1)[1].lower()
+    temp_path, digest, size = _stream_to_temp(file)
+    try:
+        # Тот же файл мог быть загружен раньше с другим расширением - используем его адрес
+        existing = conn.execute('SELECT url FROM uploads WHERE hash = ?', (digest,)).fetchone()
+        if existing:
+            url = existing['url']
+            path = upload_path_from_url(url)
+        else:
+            path, url = upload_location(digest, extension)
+        result = _place_upload(temp_path, path, url, variants)
+        conn.execute('''
+            INSERT INTO uploads (hash, url, size, refcount, created_at) VALUES (?, ?, ?, 0, ?)
+            ON CONFLICT (hash) DO NOTHING
+        ''', (digest, url, size, int(time.time())))
+        # Вставка взяла блокировку записи. Если release_uploads() успела удалить
+        # такой же файл между записью на диск и вставкой, восстанавливаем его.
+        if not os.path.exists(path):
+            result = _place_upload(temp_path, path, url, variants)
+    finally:
+        os.remove(temp_path)
+    return url, (json.dumps(result) if result else None)
+
+
+def referenced_upload_urls(conn, urls):
+    """
+    Возвращает те из URL загрузок, на которые ссылаются listings.image, users.profile_image
+    или таблица uploads (один запрос, проверка по индексам).
+    """
+    return {row[0] for row in conn.execute('''
+        SELECT value FROM json_each(?)
+        WHERE EXISTS (SELECT 1 FROM listings WHERE image = value)
+           OR EXISTS (SELECT 1 FROM users WHERE profile_image = value)
+           OR EXISTS (SELECT 1 FROM uploads WHERE url = value)
+    ''', (json.dumps(list(urls)),))}
+
+
+def _remove_upload_files(conn, url):
+    """
+    Удаляет с диска файл загрузки и его уменьшенные копии.
+    Копии ищутся только по именам, которые дает make_image_variants ("<имя>_<вариант>.webp/.jpg"):
+    шаблон "<имя>_*" задел бы и другие загрузки (photo_2.jpg при удалении photo.jpg).
+    Файл с именем копии, на который есть ссылка в базе (старая загрузка), не удаляется.
+    """
+    path = upload_path_from_url(url)
+    stem = os.path.splitext(path)[0]
+    url_stem = os.path.splitext(url)[0]
+    variants = {f'{url_stem}_{name}.{extension}': f'{stem}_{name}.{extension}'
+                for name in app.config['IMAGE_VARIANTS'] for extension in ('webp', 'jpg')}
+    referenced = referenced_upload_urls(conn, variants)
+    for file_path in [path] + [variant for variant_url, variant in variants.items() if variant_url not in referenced]:
+        try:
+            os.remove(file_path)
+        except FileNotFoundError:
+            pass
+
+
+def release_uploads(conn=None, limit=None):
+    """
+    Удаляет файлы загрузок, на которые больше не ссылается ни одно объявление и ни один профиль.
+    Вызывается после удаления объявлений и пользователей и после смены фото профиля
+    (обычно в фоне, через upload_cleaner).
+    Файлы удаляются под блокировкой записи, чтобы не разойтись с параллельной загрузкой того же файла;
+    limit ограничивает количество файлов за один вызов (и время удержания блокировки).
+    Возвращает количество удаленных файлов.
+    """
+    conn = conn or get_db()
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        sql = 'SELECT hash, url FROM uploads WHERE refcount <= 0'
+        rows = conn.execute(sql + ' LIMIT ?' if limit else sql, (limit,) if limit else ()).fetchall()
+        for row in rows:
+            _remove_upload_files(conn, row['url'])
+        conn.executemany('DELETE FROM uploads WHERE hash = ?', [(row['hash'],) for row in rows])
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        raise
+    return len(rows)
+
+
+class UploadCleaner:
+    """
+    Фоновое удаление файлов загрузок без ссылок: запрос только отмечает, что файлы
+    освободились (schedule), а удаляет их отдельный поток порциями по UPLOAD_CLEANUP_BATCH,
+    со своим соединением с базой. Несколько отметок подряд дают один проход.
+    """
+
+    def __init__(self):
+        self._wakeup = threading.Event()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+
+    def schedule(self):
+        """
+        Запускает проход очистки (поток создается при первом вызове в процессе).
+        """
+        with self._lock:
+            # После fork() потока в дочернем процессе нет - создаем новый
+            if self._thread is None or self._pid != os.getpid() or not self._thread.is_alive():
+                self._wakeup = threading.Event()
+                self._thread = threading.Thread(target=self._run, name='upload-cleaner', daemon=True)
+                self._pid = os.getpid()
+                self._thread.start()
+            self._wakeup.set()
+
+    def _run(self):
+        wakeup = self._wakeup
+        while True:
+            wakeup.wait()
+            wakeup.clear()
+            try:
+                conn = connect_db()
+                try:
+                    batch = app.config['UPLOAD_CLEANUP_BATCH']
+                    while release_uploads(conn, batch) == batch:
+                        pass
+                finally:
+                    conn.close()
+            except Exception:
+                app.logger.exception('Ошибка фонового удаления файлов загрузок')
+
+
+upload_cleaner = UploadCleaner()
+
+
+def iter_upload_files(folder):
+    """
+    Обходит папку загрузок через os.scandir, не собирая список всех файлов в памяти.
+    Выдает (путь относительно папки через '/', os.DirEntry).
+    Временные файлы незавершенных загрузок (*.part) пропускаются.
+    """
+    stack = ['']
+    while stack:
+        relative = stack.pop()
+        try:
+            with os.scandir(os.path.join(folder, *relative.split('/'))) as entries:
+                for entry in entries:
+                    name = f'{relative}/{entry.name}' if relative else entry.name
+                    if entry.is_dir(follow_symlinks=False):
+                        stack.append(name)
+                    elif entry.is_file(follow_symlinks=False) and not entry.name.endswith('.part'):
+                        yield name, entry
+        except FileNotFoundError:  # Папку удалили во время обхода
+            continue
+
+
+def _is_orphan_variant(path):
+    """
+    Для уменьшенной копии (<имя>_<вариант>.<расширение>) - True, если исходного файла уже нет,
+    и False, если он есть (копия удаляется вместе с ним). Для остальных файлов - None.
+    """
+    folder, filename = os.path.split(path)
+    stem, _, variant = os.path.splitext(filename)[0].rpartition('_')
+    if not stem or variant not in app.config['IMAGE_VARIANTS']:
+        return None
+    return not glob.glob(glob.escape(os.path.join(folder, stem)) + '.*')
+
+
+def collect_upload_garbage(grace_period, dry_run=False, batch_size=200, rate=0, echo=None):
+    """
+    Удаляет файлы из папки загрузок, на которые не ссылаются listings.image,
+    users.profile_image и таблица uploads (файлы с записью в uploads удаляет release_uploads).
+    Файлы моложе grace_period секунд не трогаются: их загрузка может быть еще не завершена.
+    Файлы сравниваются с базой порциями по batch_size; порция удаляется под блокировкой
+    записи, чтобы параллельная загрузка того же файла (store_upload) его восстановила.
+    rate - сколько файлов в секунду просматривать (0 - без ограничения), чтобы не мешать
+    запросам сайта. dry_run - только отчет, без удаления.
+    echo(url, size) вызывается для каждого найденного файла-сироты.
+    Возвращает сводку.
+    """
+    folder = app.config['UPLOAD_FOLDER']
+    report = {'scanned': 0, 'recent': 0, 'orphans': 0, 'bytes': 0, 'removed': 0}
+    cutoff = time.time() - grace_period
+    started = time.monotonic()
+
+    def candidates():
+        for relative, entry in iter_upload_files(folder):
+            report['scanned'] += 1
+            if rate and report['scanned'] % 100 == 0:
+                # Ограничение скорости: не опережаем rate файлов в секунду
+                ahead = report['scanned'] / rate - (time.monotonic() - started)
+                if ahead > 0:
+                    time.sleep(ahead)
+            try:
+                stat = entry.stat(follow_symlinks=False)
+            except FileNotFoundError:
+                continue
+            if stat.st_mtime > cutoff:
+                report['recent'] += 1
+                continue
+            orphan_variant = _is_orphan_variant(entry.path)
+            if orphan_variant is False:
+                continue
+            yield f'/static/uploads/{relative}', entry.path, stat.st_size
+
+    conn = connect_db()
+    try:
+        for batch in batched(candidates(), batch_size):
+            if not dry_run:
+                conn.execute('BEGIN IMMEDIATE')
+            try:
+                # Ссылки проверяются по индексам: listings.image, users.profile_image, uploads.url
+                referenced = referenced_upload_urls(conn, [url for url, _, _ in batch])
+                for url, path, size in batch:
+                    if url in referenced:
+                        continue
+                    report['orphans'] += 1
+                    report['bytes'] += size
+                    if echo:
+                        echo(url, size)
+                    if not dry_run:
+                        _remove_upload_files(conn, url)  # Вместе с уменьшенными копиями
+                        report['removed'] += 1
+            finally:
+                if conn.in_transaction:
+                    conn.commit()
+    finally:
+        conn.close()
+    return report
+
+
+def _resize_to_width(image, width):
+    """
+    Уменьшает изображение до заданной ширины с сохранением пропорций (без увеличения).
+    """
+    if image.width <= width:
+        return image.copy()
+    height = max(1, round(image.height * width / image.width))
+    return image.resize((width, height), Image.LANCZOS)
+
+
+def make_image_variants(file_path, url, variants):
+    """
+    Создает уменьшенные копии изображения рядом с оригиналом ("<имя>_<вариант>.webp/.jpg").
+    url - URL оригинала, от него строятся URL копий.
+    variants - имена вариантов из IMAGE_VARIANTS ('card', 'detail', 'avatar').
+    Каждый вариант сохраняется в WebP и в JPEG (для браузеров без WebP);
+    уже существующие копии не пересоздаются.
+    Возвращает словарь {вариант: {"width": ..., "webp": URL, "jpeg": URL}}
+    или None, если Pillow не установлен или файл не удалось прочитать как изображение.
+    """
+    if Image is None:
+        return None
+    folder, filename = os.path.split(file_path)
+    stem = os.path.splitext(filename)[0]
+    url_folder = url.rsplit('/', 1)[0]
+    quality = app.config['IMAGE_QUALITY']
+    result = {}
+    image = None
+    try:
+        for name in variants:
+            paths = {fmt: os.path.join(folder, f"{stem}_{name}.{extension}")
+                     for fmt, extension in (('webp', 'webp'), ('jpeg', 'jpg'))}
+            urls = {fmt: f"{url_folder}/{os.path.basename(path)}" for fmt, path in paths.items()}
+            if all(os.path.exists(path) for path in paths.values()):
+                # Копия уже есть (тот же файл загружали раньше): читаем только заголовок
+                with Image.open(paths['jpeg']) as existing:
+                    result[name] = dict(urls, width=existing.width)
+                continue
+            if image is None:
+                with Image.open(file_path) as source:
+                    # Учитываем поворот из EXIF и приводим к RGB (JPEG не поддерживает прозрачность)
+                    image = ImageOps.exif_transpose(source).convert('RGB')
+            width = app.config['IMAGE_VARIANTS'][name]
+            if name == 'avatar':
+                # Аватар - квадрат, обрезанный по центру
+                size = min(width, image.width, image.height)
+                variant = ImageOps.fit(image, (size, size), Image.LANCZOS)
+            else:
+                variant = _resize_to_width(image, width)
+            variant.save(paths['webp'], 'WEBP', quality=quality)
+            variant.save(paths['jpeg'], 'JPEG', quality=quality, optimize=True)
+            result[name] = dict(urls, width=variant.width)
+    except (OSError, ValueError, Image.DecompressionBombError):
+        # Поврежденный или неподдерживаемый файл: используем оригинал без вариантов
+        return None
+    return result
+
+
+@app.template_filter('image_variants')
+def image_variants_filter(value):
+    """
+    Jinja-фильтр: разбирает JSON с вариантами изображения (или возвращает пустой словарь).
+    """
+    if not value:
+        return {}
+    try:
+        return json.loads(value)
+    except ValueError:
+        return {}
+
+
+@app.template_filter('srcset')
+def srcset_filter(variants, fmt, names):
+    """
+    Jinja-фильтр: строит значение атрибута srcset из вариантов изображения
+    ("url1 480w, url2 1280w") для указанного формата (webp или jpeg).
+    """
+    return ', '.join(f"{variants[name][fmt]} {variants[name]['width']}w"
+                     for name in names if name in variants)
+
+
+# ---------- КЭШ РЕЗУЛЬТАТОВ ПОИСКА ----------
+# Кэш страниц /rent и /sale в памяти процесса и счетчик версии объявлений для его сброса.
+
+class AppBytecodeCache(FileSystemBytecodeCache):
+    """
+    Кэш скомпилированных шаблонов Jinja в каталоге JINJA_BYTECODE_CACHE_DIR.
+    Каталог определяется при первой компиляции шаблона, а не при импорте модуля,
+    поэтому настройку можно задать после импорта. Запись кэша сверяется с исходным
+    текстом шаблона: измененный шаблон компилируется заново.
+    """
+
+    def __init__(self):
+        # Пустой каталог - "определить при первом использовании" (см. сеттер directory)
+        super().__init__(directory='')
+
+    @property
+    def directory(self):
+        if self._directory is None:
+            directory = app.config['JINJA_BYTECODE_CACHE_DIR']
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self._directory = directory or self._get_default_cache_dir()
+        return self._directory
+
+    @directory.setter
+    def directory(self, value):
+        # FileSystemBytecodeCache.__init__ присваивает каталог; пустое значение - "определить позже"
+        self._directory = value or None
+
+
+class QueryCache:
+    """
+    Потокобезопасный LRU-кэш с ограничением времени жизни записей.
+    Все записи относятся к одной версии данных: при смене версии кэш очищается целиком,
+    поэтому после добавления или удаления объявления устаревшие результаты не выдаются.
+    Размер и время жизни берутся из настроек <setting>_SIZE и <setting>_TTL при каждом
+    обращении, поэтому их можно изменить и после импорта модуля (тесты, замеры).
+    """
+
+    def __init__(self, setting):
+        self.setting = setting
+        self.version = None
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, version):
+        """
+        Возвращает сохраненное значение или None, если его нет, оно устарело
+        или было вычислено для другой версии данных.
+        """
+        with self._lock:
+            self._sync_version(version)
+            entry = self._entries.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, version, value):
+        """
+        Сохраняет значение, вычисленное для указанной версии данных.
+        """
+        with self._lock:
+            self._sync_version(version)
+            if version != self.version:
+                return
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    @property
+    def maxsize(self):
+        return app.config[f'{self.setting}_SIZE']
+
+    @property
+    def ttl(self):
+        return app.config[f'{self.setting}_TTL']
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        """
+        Статистика использования кэша (для админки и мониторинга).
+        """
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'size': len(self._entries),
+                'maxsize': self.maxsize,
+                'ttl': self.ttl,
+                'version': self.version,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / lookups, 4) if lookups else 0.0,
+                'invalidations': self.invalidations,
+            }
+
+    def _sync_version(self, version):
+        # Вызывается под блокировкой: новая версия данных делает все записи устаревшими
+        if version != self.version:
+            if self._entries:
+                self.invalidations += 1
+            self._entries.clear()
+            self.version = version
+
+
+# Кэш страниц результатов поиска объявлений
+listings_cache = QueryCache('LISTINGS_CACHE')
+
+# Кэш отрисованных карточек объявлений: (макрос, id объявления, ревизия) -> HTML.
+# Общая версия не нужна: изменение объявления увеличивает его ревизию (триггер миграции 8)
+card_cache = QueryCache('CARD_CACHE')
+
+# Кэш избранного: (id пользователя, ревизия избранного) -> множество id объявлений.
+# Общая версия не используется: после изменения избранного у пользователя меняется ревизия,
+# и старая запись просто перестает запрашиваться (и вытесняется по LRU)
+favorites_cache = QueryCache('FAVORITES_CACHE')
+
+# Jinja: кэш скомпилированных шаблонов на диске
+# (после перезапуска шаблоны не нужно компилировать заново)
+app.jinja_env.bytecode_cache = AppBytecodeCache()
+
+
+def get_listings_version(conn=None):
+    """
+    Возвращает текущую версию данных объявлений.
+    Счетчик хранится в базе, поэтому изменения видны всем рабочим процессам.
+    """
+    conn = conn or get_db()
+    row = conn.execute("SELECT value FROM app_state WHERE key = 'listings_version'").fetchone()
+    return row[0] if row else 0
+
+
+def bump_listings_version(conn):
+    """
+    Увеличивает версию данных объявлений. Вызывается в той же транзакции,
+    что и изменение таблицы listings (добавление или удаление объявления).
+    """
+    conn.execute("UPDATE app_state SET value = value + 1 WHERE key = 'listings_version'")
+
+
+# ---------- УСЛОВНЫЕ ЗАПРОСЫ (ETag) ----------
+# Страницы получают ETag из версий данных, по которым они построены. Если у браузера
+# (или у обратного прокси) уже есть страница с тем же ETag, отвечаем 304 без запросов
+# к данным и без отрисовки шаблона.
+
+def _build_render_revision():
+    """
+    Версия шаблонов и CSS: от нее тоже зависит HTML страницы,
+    поэтому после обновления сайта старые ETag перестают совпадать.
+    """
+    digest = hashlib.sha256()
+    for entry in asset_manifest.values():
+        digest.update(entry['filename'].encode())
+    for path in sorted(glob.glob(os.path.join(app.root_path, app.template_folder, '*.html'))):
+        with open(path, 'rb') as f:
+            digest.update(f.read())
+    return digest.hexdigest()[:12]
+
+
+# Вычисляется один раз при запуске
+render_revision = _build_render_revision()
+
+
+def page_etag(*parts):
+    """
+    Строит ETag страницы из версий данных (parts), текущего пользователя
+    (от него зависит меню в шапке) и версии шаблонов.
+    """
+    key = '|'.join(str(part) for part in (render_revision, session.get('user_id'), session.get('role')) + parts)
+    return hashlib.sha1(key.encode()).hexdigest()[:20]
+
+
+def cache_headers(response, public=False):
+    """
+    Заголовки кэширования страницы с ETag. По умолчанию (no-cache) копию можно хранить,
+    но перед использованием ее нужно перепроверить по ETag. public=True - страница
+    одинакова для всех анонимных посетителей: ее на PUBLIC_PAGE_MAX_AGE секунд может
+    сохранить и общий кэширующий прокси. Vary: Cookie - ответ зависит от сессии.
+    """
+    if public:
+        response.headers['Cache-Control'] = f"public, max-age={app.config['PUBLIC_PAGE_MAX_AGE']}"
+    else:
+        response.headers['Cache-Control'] = 'no-cache'
+    response.vary.add('Cookie')
+    return response
+
+
+def not_modified(etag, weak=False, public=False):
+    """
+    Возвращает ответ 304, если браузер прислал совпадающий If-None-Match, иначе None.
+    Если в сессии ждут показа flash-сообщения, страницу нужно отрисовать заново.
+    If-None-Match всегда сравнивается слабо (так требует HTTP): сжатый ответ
+    получает слабую версию ETag (см. compress_response), и она тоже должна совпадать.
+    """
+    if session.get('_flashes'):
+        return None
+    if not request.if_none_match.contains_weak(etag):
+        return None
+    response = app.response_class(status=304)
+    response.set_etag(etag, weak=weak)
+    return cache_headers(response, public)
+
+
+def with_etag(body, etag, weak=False, public=False):
+    """
+    Добавляет к отрисованной странице ETag и заголовки кэширования (см. cache_headers).
+    """
+    response = app.make_response(body)
+    response.set_etag(etag, weak=weak)
+    return cache_headers(response, public)
+
+
+# ---------- ОБЪЯВЛЕНИЯ ----------
+# Маршруты и функции, связанные с отображением, добавлением и управлением объявлениями.
+
+# Карточка объявления в списках (/rent, /sale, избранное, профиль): только нужные
+# для карточки колонки, описание и детали обрезаются прямо в SQL.
+# Полная строка объявления загружается только на странице listing_detail.
+ListingCard = namedtuple('ListingCard', [
+    'id', 'revision', 'image', 'image_variants', 'price', 'rooms', 'deal_type', 'housing_type', 'city', 'area', 'phone', 'user_id',
+    'description', 'details',
+])
+
+# Текстовые колонки, которые в карточке показываются только началом
+_SNIPPET_COLUMNS = ('description', 'details')
+
+
+def listing_card_columns(alias='listings'):
+    """
+    Возвращает список колонок для SELECT карточек объявлений (в порядке полей ListingCard).
+    alias - имя или псевдоним таблицы listings в запросе.
+    """
+    length = int(app.config['LISTING_SNIPPET_LENGTH'])
+    columns = [f'{alias}.{name}' for name in ListingCard._fields if name not in _SNIPPET_COLUMNS]
+    for name in _SNIPPET_COLUMNS:
+        columns.append(f"CASE WHEN length({alias}.{name}) > {length} "
+                       f"THEN substr({alias}.{name}, 1, {length}) || '…' ELSE {alias}.{name} END")
+    return ', '.join(columns)
+
+
+def listing_card_cursor():
+    """
+    Возвращает курсор, строки которого превращаются в ListingCard.
+    """
+    c = get_db().cursor()
+    c.row_factory = lambda cursor, row: ListingCard._make(row)
+    return c
+
+
+@app.template_global()
+def listing_card(macro_name, item):
+    """
+    HTML карточки объявления item (ListingCard), отрисованной макросом macro_name из cards.html.
+    Готовая карточка хранится в card_cache по id и ревизии объявления и используется
+    на всех страницах и для всех пользователей. Поэтому макросы карточек не выводят
+    данных текущего пользователя: кнопку избранного шаблоны выводят рядом с карточкой.
+    """
+    key = (macro_name, item.id, item.revision)
+    html = card_cache.get(key, None)
+    if html is None:
+        html = get_template_attribute('cards.html', macro_name)(item)
+        card_cache.put(key, None, html)
+    return html
+
+
+# Сортировки списка объявлений для постраничного вывода (keyset-пагинация).
+# keys - SQL-выражения ключа страницы (последним всегда идет уникальный id),
+# descending - направление сортировки, search - сортировка доступна только при поиске по словам.
+LISTING_SORTS = {
+    'id': {'keys': ('listings.id',), 'descending': True},                     # сначала новые
+    'price': {'keys': ('listings.price', 'listings.id'), 'descending': False},  # сначала дешевые
+    # Сначала самые подходящие: rank в FTS5 - это bm25, чем меньше, тем релевантнее
+    'relevance': {'keys': ('listings_fts.rank', 'listings.id'), 'descending': False, 'search': True},
+}
+
+
+def fts_query(text, column=None):
+    """
+    Превращает пользовательский ввод в безопасный запрос FTS5: каждое слово
+    ищется как префикс (чтобы "квартир" находило "квартира" и "квартиры"),
+    все слова должны встретиться одновременно. column ограничивает поиск одной колонкой.
+    Возвращает None, если в тексте нет ни одного слова.
+    """
+    words = re.findall(r'\w+', text.lower())
+    if not words:
+        return None
+    query = ' '.join(f'"{word}"*' for word in words)
+    return f'{column} : ({query})' if column else query
+
+
+def parse_listing_filters(source):
+    """
+    Читает фильтры объявлений из формы или строки запроса и нормализует их.
+    Возвращает словарь только с заданными (непустыми и корректными) фильтрами.
+    """
+    filters = {}
+    # Числовые фильтры: некорректные значения просто игнорируются
+    for name in ('min_price', 'max_price', 'rooms'):
+        value = (source.get(name) or '').strip()
+        if value.isdigit():
+            filters[name] = int(value)
+    for name in ('city', 'housing_type'):
+        value = (source.get(name) or '').strip()
+        if value:
+            filters[name] = value
+    # Ключевые слова для полнотекстового поиска: нижний регистр, только слова через пробел
+    words = re.findall(r'\w+', (source.get('q') or '').lower())
+    if words:
+        filters['q'] = ' '.join(words)
+    # Если выбран тип жилья "комната", то фильтр по количеству комнат игнорируется
+    if filters.get('housing_type') == 'комната':
+        filters.pop('rooms', None)
+    return filters
+
+
+def build_listing_where(deal_type, filters):
+    """
+    Строит источник строк (FROM), условия WHERE и значения параметров для выборки
+    объявлений заданного типа сделки (None - любого) с учетом фильтров из parse_listing_filters().
+    """
+    source = 'listings'
+    clauses = []
+    values = []
+    if deal_type:
+        clauses.append('listings.deal_type = ?')
+        values.append(deal_type)
+    if 'q' in filters:
+        # Поиск по словам в описании, деталях и городе через индекс FTS5
+        source = 'listings JOIN listings_fts ON listings_fts.rowid = listings.id'
+        clauses.append('listings_fts MATCH ?')
+        values.append(fts_query(filters['q']))
+    if 'city' in filters:
+        clauses.append('listings.city = ?')
+        values.append(filters['city'])
+    if 'city_prefix' in filters:
+        # Город по началу слов (поиск в админке) - через индекс FTS5 вместо LIKE '%...%'
+        clauses.append('listings.id IN (SELECT rowid FROM listings_fts WHERE listings_fts MATCH ?)')
+        values.append(fts_query(filters['city_prefix'], column='city'))
+    if 'housing_type' in filters:
+        clauses.append('listings.housing_type = ?')
+        values.append(filters['housing_type'])
+    if 'rooms' in filters:
+        clauses.append('listings.rooms = ?')
+        values.append(filters['rooms'])
+    if 'min_price' in filters:
+        clauses.append('listings.price >= ?')
+        values.append(filters['min_price'])
+    if 'max_price' in filters:
+        clauses.append('listings.price <= ?')
+        values.append(filters['max_price'])
+    return source, clauses, values
+
+
+def encode_cursor(key):
+    """
+    Кодирует значения ключа строки в строку курсора ('42', '1500_42' или '-3.5_42').
+    """
+    return '_'.join(repr(value) for value in key)
+
+
+def decode_cursor(value, sort):
+    """
+    Разбирает строку курсора. Возвращает кортеж значений ключа или None, если курсор некорректен.
+    """
+    parts = (value or '').split('_')
+    if len(parts) != len(LISTING_SORTS[sort]['keys']):
+        return None
+    key = []
+    for part in parts:
+        try:
+            key.append(int(part))
+        except ValueError:
+            try:
+                key.append(float(part))  # rank при сортировке по релевантности
+            except ValueError:
+                return None
+    return tuple(key)
+
+
+def listing_page_query(deal_type, filters, sort, columns, after=None, before=None, limit=None, descending=None):
+    """
+    Строит запрос выборки объявлений с keyset-пагинацией: (sql, values).
+    Вместо OFFSET используется условие по ключу последней показанной строки,
+    поэтому стоимость запроса не зависит от номера страницы.
+    columns - SQL-выражения колонок; после них в каждой строке идут значения ключа сортировки.
+    При before строки выбираются в обратном порядке (страницу нужно развернуть).
+    limit=None - без ограничения (потоковая выгрузка).
+    descending - направление сортировки, если оно отличается от принятого в LISTING_SORTS.
+    """
+    keys = LISTING_SORTS[sort]['keys']
+    if descending is None:
+        descending = LISTING_SORTS[sort]['descending']
+    source, clauses, values = build_listing_where(deal_type, filters)
+
+    backward = before is not None
+    cursor = before if backward else after
+    # При переходе назад читаем в обратном порядке и затем разворачиваем страницу
+    descending = descending != backward
+    if cursor is not None:
+        key = '(' + ', '.join(keys) + ')'
+        placeholders = '(' + ', '.join('?' for _ in keys) + ')'
+        clauses.append(f"{key} {'<' if descending else '>'} {placeholders}")
+        values.extend(cursor)
+    direction = 'DESC' if descending else 'ASC'
+    order_by = ', '.join(f'{key} {direction}' for key in keys)
+
+    sql = f"SELECT {columns}, {', '.join(keys)} FROM {source}"
+    if clauses:
+        sql += f" WHERE {' AND '.join(clauses)}"
+    sql += f" ORDER BY {order_by}"
+    if limit is not None:
+        sql += " LIMIT ?"
+        values.append(limit)
+    return sql, values
+
+
+def fetch_listings_page(deal_type, filters, sort='id', after=None, before=None, page_size=None, fields=None,
+                        descending=None):
+    """
+    Возвращает одну страницу объявлений: (listings, next_cursor, prev_cursor).
+    after - курсор, после которого начинается страница (переход вперед),
+    before - курсор, перед которым она заканчивается (переход назад).
+    fields - колонки listings для API и админки (строки - словари); по умолчанию строки - ListingCard.
+    descending - направление сортировки (см. listing_page_query).
+    """
+    page_size = page_size or app.config['LISTINGS_PAGE_SIZE']
+    backward = before is not None
+    if fields:
+        columns = ', '.join(f'listings.{name}' for name in fields)
+        width = len(fields)
+        make_row = lambda row: dict(zip(fields, row))
+    else:
+        columns = listing_card_columns()
+        width = len(ListingCard._fields)
+        make_row = ListingCard._make
+
+    # Берем на одну строку больше, чтобы узнать, есть ли следующая страница.
+    # После колонок выбираются значения ключа - из них строятся курсоры.
+    sql, values = listing_page_query(deal_type, filters, sort, columns, after, before, page_size + 1, descending)
+    c = get_db().cursor()
+    c.row_factory = None
+    rows = c.execute(sql, values).fetchall()
+    has_more = len(rows) > page_size
+    rows = rows[:page_size]
+    if backward:
+        rows.reverse()
+
+    listings = [make_row(row[:width]) for row in rows]
+    next_cursor = prev_cursor = None
+    if rows:
+        if has_more or backward:
+            next_cursor = encode_cursor(rows[-1][width:])
+        if (has_more and backward) or (after is not None and not backward):
+            prev_cursor = encode_cursor(rows[0][width:])
+    return listings, next_cursor, prev_cursor
+
+
+def listings_cache_key(deal_type, filters, sort, after, before):
+    """
+    Ключ страницы в listings_cache: нормализованный набор фильтров, сортировка и позиция страницы.
+    """
+    return (deal_type, tuple(sorted(filters.items())), sort, after, before, app.config['LISTINGS_PAGE_SIZE'])
+
+
+def cached_listings_page(deal_type, filters, sort='id', after=None, before=None, version=None):
+    """
+    То же, что fetch_listings_page(), но с кэшированием результата.
+    Кэш сбрасывается при изменении версии объявлений (version, если уже известна).
+    """
+    key = listings_cache_key(deal_type, filters, sort, after, before)
+    if version is None:
+        version = get_listings_version()
+    page = listings_cache.get(key, version)
+    if page is None:
+        page = fetch_listings_page(deal_type, filters, sort, after, before)
+        listings_cache.put(key, version, page)
+    return page
+
+
+class ListingsPage:
+    """
+    Страница объявлений /rent или /sale, которая читается из курсора SQLite по мере того,
+    как шаблон выводит карточки (при потоковой отрисовке они сразу уходят клиенту).
+    Курсоры соседних страниц (next_cursor, prev_cursor) известны после перебора всех строк.
+    Прочитанная до конца страница сохраняется в listings_cache, страница из кэша
+    перебирается без запросов к базе.
+    """
+
+    def __init__(self, deal_type, filters, sort, after, before, version):
+        self.query = (deal_type, filters, sort, after, before)
+        self.key = listings_cache_key(deal_type, filters, sort, after, before)
+        self.version = version
+        self.listings, self.next_cursor, self.prev_cursor = listings_cache.get(self.key, version) or (None, None, None)
+
+    def __iter__(self):
+        if self.listings is not None:
+            yield from self.listings
+            return
+        deal_type, filters, sort, after, before = self.query
+        if before is not None:
+            # Страница "назад" выбирается в обратном порядке: ее нужно прочитать целиком и развернуть
+            self.listings, self.next_cursor, self.prev_cursor = cached_listings_page(
+                deal_type, filters, sort, after, before, self.version)
+            yield from self.listings
+            return
+
+        page_size = app.config['LISTINGS_PAGE_SIZE']
+        width = len(ListingCard._fields)
+        # Как в fetch_listings_page: лишняя строка показывает, что есть следующая страница
+        sql, values = listing_page_query(deal_type, filters, sort, listing_card_columns(), after, limit=page_size + 1)
+        c = get_db().cursor()
+        c.row_factory = None
+        c.execute(sql, values)
+        listings = []
+        first_key = last_key = next_cursor = None
+        try:
+            for row in c:
+                if len(listings) == page_size:
+                    next_cursor = encode_cursor(last_key)
+                    break
+                card = ListingCard._make(row[:width])
+                listings.append(card)
+                last_key = row[width:]
+                first_key = first_key or last_key
+                yield card
+        finally:
+            c.close()
+        prev_cursor = encode_cursor(first_key) if after is not None and first_key else None
+        self.listings, self.next_cursor, self.prev_cursor = listings, next_cursor, prev_cursor
+        listings_cache.put(self.key, self.version, (listings, next_cursor, prev_cursor))
+
+
+@app.template_global()
+def stream_flush():
+    """
+    Отметка в шаблоне, отрисовываемом потоком: накопленный HTML нужно сразу отправить
+    клиенту (ставится перед частью страницы, которая ждет запроса к базе).
+    """
+    g.stream_flush = True
+    return ''
+
+
+def buffered_stream(chunks, size=None):
+    """
+    Объединяет мелкие части потоковой отрисовки шаблона в блоки не меньше size символов
+    (по умолчанию STREAM_CHUNK_SIZE). Накопленное отправляется раньше, если шаблон
+    вызвал stream_flush(). Генератор нужно оборачивать в stream_with_context.
+    """
+    size = size or app.config['STREAM_CHUNK_SIZE']
+    buffer = []
+    buffered = 0
+    for chunk in chunks:
+        buffer.append(chunk)
+        buffered += len(chunk)
+        if buffered >= size or g.pop('stream_flush', False):
+            yield ''.join(buffer)
+            buffer = []
+            buffered = 0
+    if buffer:
+        yield ''.join(buffer)
+
+
+def listings_query_args(filters, sort, default_sort, after=None, before=None):
+    """
+    Канонические параметры строки запроса страницы /rent или /sale: только заданные
+    фильтры в нормализованном виде, сортировка - только если она не по умолчанию,
+    и курсор страницы (after/before - строки курсоров). Параметры упорядочены по имени, поэтому одинаковый поиск
+    всегда получает один и тот же URL (и одну запись в кэше браузера или прокси).
+    """
+    args = dict(filters)
+    if sort != default_sort:
+        args['sort'] = sort
+    # Курсор before главнее after (см. fetch_listings_page)
+    if before:
+        args['before'] = before
+    elif after:
+        args['after'] = after
+    return dict(sorted(args.items()))
+
+
+def render_listings_page(endpoint, template, deal_type):
+    """
+    Общая логика страниц /rent и /sale: читает фильтры из строки запроса,
+    выбирает страницу объявлений и отображает шаблон.
+    Поиск из формы POST и неканонические адреса перенаправляются на канонический URL.
+    """
+    filters = parse_listing_filters(request.values)
+    # При поиске по словам по умолчанию показываем самые релевантные объявления
+    default_sort = 'relevance' if 'q' in filters else 'id'
+    sort = request.values.get('sort') or default_sort
+    if sort not in LISTING_SORTS or (LISTING_SORTS[sort].get('search') and 'q' not in filters):
+        sort = default_sort
+    after = decode_cursor(request.args.get('after'), sort)
+    before = decode_cursor(request.args.get('before'), sort)
+
+    # Пустые поля формы, сортировка по умолчанию, порядок и запись параметров
+    # не должны давать разные URL для одного и того же поиска
+    query_args = listings_query_args(filters, sort, default_sort,
+                                     after=after and encode_cursor(after), before=before and encode_cursor(before))
+    if request.method == 'POST':
+        # Старые формы поиска: после POST браузер переходит на GET-адрес результатов
+        return redirect(url_for(endpoint, **query_args), code=303)
+    if list(request.args.items(multi=True)) != [(name, str(value)) for name, value in query_args.items()]:
+        return redirect(url_for(endpoint, **query_args), code=301)
+
+    # Слабый ETag по версии объявлений (и ревизии избранного, от которого зависят
+    # отметки на карточках): пока они не менялись, страница с теми же параметрами не меняется
+    version = get_listings_version()
+    user_id = session.get('user_id')
+    favorites_revision = get_favorites_revision(user_id) if user_id else None
+    # Страницу для анонимного посетителя (без ожидающих flash-сообщений) может хранить
+    # и общий кэширующий прокси
+    public = not user_id and not session.get('_flashes')
+    etag = page_etag('listings', version, favorites_revision)
+    response = not_modified(etag, weak=True, public=public)
+    if response is not None:
+        return response
+
+    # Строки страницы читаются из базы (или из кэша), пока шаблон выводит карточки
+    listings = ListingsPage(deal_type, filters, sort, after, before, version)
+
+    def page_links():
+        # Ссылки "назад/вперед" сохраняют активные фильтры и сортировку. Шаблон вызывает
+        # функцию после вывода карточек: курсоры известны, когда страница прочитана
+        next_url = prev_url = None
+        if listings.next_cursor:
+            next_url = url_for(endpoint, **listings_query_args(filters, sort, default_sort, after=listings.next_cursor))
+        if listings.prev_cursor:
+            prev_url = url_for(endpoint, **listings_query_args(filters, sort, default_sort, before=listings.prev_cursor))
+        return prev_url, next_url
+
+    # Отмечаем избранные объявления (множество id избранного берется из кэша)
+    favorited = favorite_ids(user_id, favorites_revision) if user_id else ()
+
+    context = dict(listings=listings, filters=filters, sort=sort,
+                   housing_type=filters.get('housing_type', ''), rooms=filters.get('rooms', ''),
+                   page_links=page_links, favorited=favorited)
+    if app.config['LISTINGS_STREAM']:
+        # flash-сообщения забираем из сессии до начала ответа: cookie сессии уходит вместе
+        # с заголовками, и изменение сессии во время отрисовки потока уже не сохранилось бы.
+        # Flask запоминает их на время запроса, и шаблон выводит их как обычно
+        get_flashed_messages(with_categories=True)
+        # Шапка и форма поиска уходят клиенту до запроса к базе, карточки - по мере чтения строк.
+        # Ошибку после начала ответа уже нельзя показать страницей 500: соединение будет оборвано
+        body = stream_with_context(buffered_stream(stream_template(template, **context)))
+    else:
+        body = render_template(template, **context)
+    return with_etag(body, etag, weak=True, public=public)
+
+
+@app.route('/rent', methods=['GET', 'POST'])
+def rent():
+    """
+    Отображает страницу с объявлениями об аренде.
+    Позволяет фильтровать объявления по цене, количеству комнат, городу и типу жилья.
+    Объявления выводятся постранично.
+    """
+    return render_listings_page('rent', 'rent.html', 'rent')
+
+
+@app.route('/sale', methods=['GET', 'POST'])
+def sale():
+    """
+    Отображает страницу с объявлениями о продаже.
+    Позволяет фильтровать объявления по цене, количеству комнат и городу.
+    Объявления выводятся постранично.
+    """
+    return render_listings_page('sale', 'sale.html', 'sale')
+
+
+def parse_bbox(value):
+    """
+    Разбирает область карты "south,west,north,east" (широта и долгота в градусах).
+    Возвращает кортеж (south, west, north, east) или None, если значение некорректно.
+    Области через 180-й меридиан не поддерживаются.
+    """
+    try:
+        south, west, north, east = (float(part) for part in (value or '').split(','))
+    except ValueError:
+        return None
+    if not (-90 <= south <= north <= 90 and -180 <= west <= east <= 180):
+        return None
+    return south, west, north, east
+
+
+def radius_bbox(lat, lon, radius):
+    """
+    Прямоугольник, описанный вокруг круга радиусом radius км с центром (lat, lon).
+    По нему R*Tree отбирает кандидатов, точное расстояние проверяется отдельно.
+    """
+    dlat = math.degrees(radius / EARTH_RADIUS_KM)
+    south, north = max(-90.0, lat - dlat), min(90.0, lat + dlat)
+    if south == -90.0 or north == 90.0:
+        return south, -180.0, north, 180.0  # круг захватывает полюс
+    dlon = dlat / max(math.cos(math.radians(lat)), 1e-9)
+    return south, max(-180.0, lon - dlon), north, min(180.0, lon + dlon)
+
+
+@app.route('/map/listings')
+def map_listings():
+    """
+    Поиск объявлений на карте (JSON).
+    Область задается либо прямоугольником bbox=south,west,north,east (видимая часть карты),
+    либо кругом lat, lon, radius (радиус в км; результаты отсортированы по расстоянию).
+    Дополнительно поддерживаются deal_type и фильтры страниц /rent и /sale
+    (min_price, max_price, rooms, city, housing_type, q).
+    Кандидатов отбирает пространственный индекс listings_geo, поэтому запрос
+    читает только объявления внутри области, а не всю таблицу.
+    """
+    deal_type = request.args.get('deal_type') or None
+    if deal_type not in (None, 'rent', 'sale'):
+        return jsonify(error='deal_type должен быть rent или sale'), 400
+    filters = parse_listing_filters(request.args)
+
+    center = None
+    if 'bbox' in request.args:
+        bbox = parse_bbox(request.args['bbox'])
+    else:
+        try:
+            lat = float(request.args['lat'])
+            lon = float(request.args['lon'])
+            radius = float(request.args['radius'])
+        except (KeyError, ValueError):
+            bbox = None
+        else:
+            valid = -90 <= lat <= 90 and -180 <= lon <= 180 and 0 < radius <= app.config['MAP_MAX_RADIUS_KM']
+            center = (lat, lon, radius) if valid else None
+            bbox = radius_bbox(lat, lon, radius) if valid else None
+    if bbox is None:
+        return jsonify(error='Укажите bbox=south,west,north,east или lat, lon и radius (км)'), 400
+
+    source, clauses, values = build_listing_where(deal_type, filters)
+    # R*Tree идет первым в соединении: он выбирает точки внутри прямоугольника,
+    # объявления читаются по первичному ключу
+    clauses[:0] = ['listings_geo.max_lat >= ?', 'listings_geo.min_lat <= ?',
+                   'listings_geo.max_lon >= ?', 'listings_geo.min_lon <= ?',
+                   'listings.id = listings_geo.id',
+                   # В R*Tree координаты хранятся с точностью float32 - уточняем по таблице
+                   'listings.latitude BETWEEN ? AND ?', 'listings.longitude BETWEEN ? AND ?']
+    south, west, north, east = bbox
+    values[:0] = [south, north, west, east, south, north, west, east]
+
+    columns = ('listings.id, listings.latitude, listings.longitude, listings.price, listings.rooms, '
+               'listings.deal_type, listings.housing_type, listings.city, listings.image')
+    if center:
+        columns += ', distance_km(?, ?, listings.latitude, listings.longitude) AS distance'
+        values[:0] = [center[0], center[1]]
+        clauses.append('distance <= ?')
+        values.append(center[2])
+        order_by = ' ORDER BY distance, listings.id'
+    else:
+        # Без сортировки: обход R*Tree останавливается, как только набран LIMIT,
+        # поэтому большая область карты обходится так же дешево, как маленькая
+        order_by = ''
+
+    limit = app.config['MAP_LISTINGS_LIMIT']
+    c = get_db().cursor()
+    c.row_factory = None
+    c.execute(f"SELECT {columns} FROM listings_geo CROSS JOIN {source} "
+              f"WHERE {' AND '.join(clauses)}{order_by} LIMIT ?",
+              values + [limit + 1])
+    rows = c.fetchall()
+
+    listings = []
+    for row in rows[:limit]:
+        item = {
+            'id': row[0], 'latitude': row[1], 'longitude': row[2], 'price': row[3], 'rooms': row[4],
+            'deal_type': row[5], 'housing_type': row[6], 'city': row[7], 'image': row[8],
+            'url': url_for('listing_detail', listing_id=row[0]),
+        }
+        if center:
+            item['distance_km'] = round(row[9], 3)
+        listings.append(item)
+    # truncated - в области больше объявлений, чем MAP_LISTINGS_LIMIT: карте стоит приблизиться
+    return jsonify(listings=listings, truncated=len(rows) > limit)
+
+
+# Допустимые значения полей объявления
+DEAL_TYPES = ('rent', 'sale')
+HOUSING_TYPES = ('дом', 'квартира', 'комната')
+
+
+def parse_listing_fields(source):
+    """
+    Проверяет и нормализует поля объявления из формы /add или строки файла импорта.
+    Возвращает словарь с полями price, rooms, description, details, deal_type,
+    housing_type, city, area, phone, latitude, longitude.
+    При некорректных данных выбрасывает ValueError с описанием ошибки.
+    """
+    def text(name):
+        value = source.get(name)
+        value = '' if value is None else str(value).strip()
+        if not value:
+            raise ValueError(f'Не заполнено поле "{name}".')
+        return value
+
+    def integer(name):
+        value = text(name)
+        try:
+            return int(value)
+        except ValueError:
+            raise ValueError(f'Поле "{name}" должно быть целым числом.') from None
+
+    fields = {
+        'price': integer('price'),
+        'description': text('description'),
+        'details': text('details'),
+        'deal_type': text('deal_type'),
+        'housing_type': text('housing_type'),
+        'city': text('city'),
+        'area': integer('area'),
+        'phone': text('phone'),
+    }
+    if fields['deal_type'] not in DEAL_TYPES:
+        raise ValueError('Тип сделки должен быть rent или sale.')
+    if fields['housing_type'] not in HOUSING_TYPES:
+        raise ValueError('Неизвестный тип жилья.')
+    # Если тип жилья "комната", количество комнат устанавливается в 1
+    fields['rooms'] = 1 if fields['housing_type'] == 'комната' else integer('rooms')
+
+    # Координаты с карты необязательны: сохраняются только парой и в допустимых пределах
+    try:
+        latitude = float(source.get('latitude') or '')
+        longitude = float(source.get('longitude') or '')
+    except (TypeError, ValueError):
+        latitude = longitude = None
+    if latitude is None or not (-90 <= latitude <= 90 and -180 <= longitude <= 180):
+        latitude = longitude = None
+    fields['latitude'] = latitude
+    fields['longitude'] = longitude
+    return fields
+
+
+@app.route('/add', methods=['GET', 'POST'])
+@login_required  # Доступ только для аутентифицированных пользователей
+def add_listing():
+    """
+    Обрабатывает добавление нового объявления.
+    При GET-запросе отображает форму добавления.
+    При POST-запросе сохраняет данные нового объявления в базу данных.
+    """
+    if request.method == 'POST':
+        # Проверка данных формы (те же правила применяются при импорте объявлений)
+        try:
+            fields = parse_listing_fields(request.form)
+        except ValueError as error:
+            flash(str(error), 'danger')
+            return render_template('add_listing.html')
+
+        conn = get_db()
+        # Обработка загрузки изображения
+        image = None
+        image_variants = None
+        if 'image' in request.files:
+            file = request.files['image']
+            # Если файл выбран и имеет разрешенное расширение
+            if file and allowed_file(file.filename):
+                # Файл хранится по хешу содержимого, копии - для карточек и страницы объявления
+                image, image_variants = store_upload(conn, file, ('card', 'detail'))
+
+        # Сохранение объявления в базу данных
+        c = conn.cursor()
+        c.execute('''
+            INSERT INTO listings
+            (image, image_variants, price, rooms, description, details, deal_type, housing_type, city, area, phone, user_id,
+             latitude, longitude)
+            VALUES (:image, :image_variants, :price, :rooms, :description, :details, :deal_type, :housing_type,
+                    :city, :area, :phone, :user_id, :latitude, :longitude)
+        ''', dict(fields, image=image, image_variants=image_variants, user_id=session.get('user_id')))
+        bump_listings_version(conn)  # Результаты поиска в кэше больше не актуальны
+        conn.commit()
+
+        flash("Объявление добавлено!")  # Сообщение об успехе
+        return redirect(url_for('profile'))  # Перенаправление на страницу профиля
+
+    # Если метод GET, отображаем форму добавления объявления
+    return render_template('add_listing.html')
+
+
+@app.route('/listing/<int:listing_id>')
+def listing_detail(listing_id):
+    """
+    Отображает детальную информацию о конкретном объявлении.
+    Включает информацию о продавце (display_name, profile_image).
+    """
+    conn = get_db()
+    c = conn.cursor()
+
+    # Сначала проверяем только ревизии объявления и автора (поиск по первичному ключу):
+    # если страница не менялась, отвечаем 304 без выборки и отрисовки
+    c.execute('''
+        SELECT l.revision, u.revision FROM listings l
+        LEFT JOIN users u ON l.user_id = u.id
+        WHERE l.id = ?
+    ''', (listing_id,))
+    revisions = c.fetchone()
+    etag = None
+    if revisions:
+        etag = page_etag('listing', listing_id, revisions[0], revisions[1])
+        response = not_modified(etag)
+        if response is not None:
+            return response
+
+    # SQL-запрос для получения данных объявления и информации о пользователе, его разместившем
+    c.execute('''
+        SELECT l.*, u.display_name, u.profile_image, u.profile_image_variants
         FROM listings l
         LEFT JOIN users u ON l.user_id = u.id
         WHERE l.id = ?
     ''', (listing_id,))
     listing = c.fetchone()  # Получаем одно объявление
-    conn.close()
 
     # Если объявление не найдено, показываем сообщение и перенаправляем
     if not listing:
@@ -578,13 +2489,63 @@ def listing_detail(listing_id):
         return redirect(url_for('rent'))
 
     # Отображаем шаблон с деталями объявления
-    return render_template('listing_detail.html', listing=listing)
+    return with_etag(render_template('listing_detail.html', listing=listing), etag)
 
 
 # ---------- ИЗБРАННОЕ ----------
 # Маршруты и функции для управления списком избранных объявлений пользователя.
 
->>>>>>> Stashed changes
+def get_favorites_revision(user_id):
+    """
+    Ревизия избранного пользователя (растет при каждом добавлении и удалении).
+    """
+    row = get_db().execute('SELECT favorites_revision FROM users WHERE id = ?', (user_id,)).fetchone()
+    return row[0] if row else 0
+
+
+def favorite_ids(user_id, revision=None):
+    """
+    Множество id избранных объявлений пользователя.
+    Загружается одним запросом по индексу (user_id, listing_id) и хранится в кэше
+    до изменения ревизии избранного (revision, если она уже известна).
+    """
+    if revision is None:
+        revision = get_favorites_revision(user_id)
+    key = (user_id, revision)
+    ids = favorites_cache.get(key, None)
+    if ids is None:
+        c = get_db().cursor()
+        c.row_factory = None
+        c.execute('SELECT listing_id FROM favorites WHERE user_id = ?', (user_id,))
+        ids = frozenset(row[0] for row in c)
+        favorites_cache.put(key, None, ids)
+    return ids
+
+
+def set_favorite(user_id, listing_id, favorited):
+    """
+    Добавляет объявление в избранное (favorited=True) или убирает из него.
+    Возвращает True, если избранное изменилось, False - если оно уже было в нужном состоянии,
+    и None, если такого объявления нет.
+    """
+    conn = get_db()
+    if favorited:
+        # Добавляем только существующее объявление; повторное добавление игнорируется
+        c = conn.execute('''
+            INSERT OR IGNORE INTO favorites (user_id, listing_id)
+            SELECT ?, id FROM listings WHERE id = ?
+        ''', (user_id, listing_id))
+        changed = c.rowcount > 0
+        if not changed and conn.execute('SELECT 1 FROM listings WHERE id = ?', (listing_id,)).fetchone() is None:
+            conn.rollback()
+            return None
+    else:
+        c = conn.execute('DELETE FROM favorites WHERE user_id = ? AND listing_id = ?', (user_id, listing_id))
+        changed = c.rowcount > 0
+    conn.commit()
+    return changed
+
+
 @app.route('/favorites')
 @login_required # Доступ только для аутентифицированных пользователей
 def favorites():
@@ -592,39 +2553,33 @@ def favorites():
     Отображает страницу с избранными объявлениями текущего пользователя.
     """
     user_id = session['user_id']  # ID текущего пользователя
-    conn = sqlite3.connect('users.db')
-    conn.row_factory = sqlite3.Row
-    c = conn.cursor()
+    c = listing_card_cursor()
 
-    # SQL-запрос для получения всех объявлений, добавленных пользователем в избранное
-    c.execute('''
-        SELECT l.*
+    # SQL-запрос для получения карточек всех объявлений, добавленных пользователем в избранное
+    c.execute(f'''
+        SELECT {listing_card_columns('l')}
         FROM listings l
         JOIN favorites f ON l.id = f.listing_id
         WHERE f.user_id = ?
     ''', (user_id,))
     favorites = c.fetchall()  # Получаем список избранных объявлений
-    conn.close()
     return render_template('favorites.html', favorites=favorites)
 
 @app.route('/add_favorite/<int:item_id>', methods=['POST'])
 @login_required # Доступ только для аутентифицированных пользователей
 def add_favorite(item_id):
     """
-    Добавляет объявление в список избранного для текущего пользователя.
+    Добавляет объявление в список избранного для текущего пользователя
+    (форма для браузеров без JavaScript; скрипт на страницах использует api_favorite).
     """
-    user_id = session['user_id']
-    conn = sqlite3.connect('users.db')
-    c = conn.cursor()
     try:
-        # Пытаемся добавить запись в таблицу favorites.
-        c.execute('INSERT OR IGNORE INTO favorites (user_id, listing_id) VALUES (?, ?)', (user_id, item_id))
-        conn.commit()
-        flash('Добавлено в избранное!')
+        if set_favorite(session['user_id'], item_id, True) is None:
+            flash('Объявление не найдено.', 'danger')
+        else:
+            flash('Добавлено в избранное!')
     except sqlite3.Error: # Более общая обработка ошибок SQLite
-        flash('Ошибка добавления в избранное.')
-    finally:
-        conn.close()
+        get_db().rollback()
+        flash('Ошибка добавления в избранное.')
     # Перенаправляем пользователя на предыдущую страницу или на страницу аренды
     return redirect(request.referrer or url_for('rent'))
 
@@ -634,21 +2589,46 @@ def remove_favorite(item_id):
     """
     Удаляет объявление из списка избранного для текущего пользователя.
     """
-    user_id = session['user_id']
-    conn = sqlite3.connect('users.db')
-    c = conn.cursor()
     try:
-        # Удаляем запись из таблицы favorites
-        c.execute('DELETE FROM favorites WHERE user_id = ? AND listing_id = ?', (user_id, item_id))
-        conn.commit()
+        set_favorite(session['user_id'], item_id, False)
         flash('Удалено из избранного.', 'success')
     except sqlite3.Error: # Более общая обработка ошибок SQLite
+        get_db().rollback()
         flash('Ошибка удаления.', 'danger')
-    finally:
-        conn.close()
     # Перенаправляем пользователя на предыдущую страницу или на страницу избранного
     return redirect(request.referrer or url_for('favorites'))
 
+@app.route('/api/favorites/<int:listing_id>', methods=['PUT', 'DELETE', 'POST'])
+def api_favorite(listing_id):
+    """
+    Избранное без перезагрузки страницы.
+    PUT - добавить, DELETE - убрать (ответ 204 без тела, повтор запроса безопасен);
+    POST - переключить, ответ 200 {"listing_id": ..., "favorited": true/false}.
+    POST принимается только с Content-Type: application/json - такой запрос
+    сторонний сайт не может отправить обычной формой.
+    """
+    user_id = session.get('user_id')
+    if not user_id:
+        return jsonify(error='Требуется вход'), 401
+    if request.method == 'POST' and not request.is_json:
+        return jsonify(error='Ожидается application/json'), 415
+
+    try:
+        if request.method == 'POST':
+            favorited = listing_id not in favorite_ids(user_id)
+        else:
+            favorited = request.method == 'PUT'
+        if set_favorite(user_id, listing_id, favorited) is None:
+            return jsonify(error='Объявление не найдено'), 404
+    except sqlite3.Error:
+        get_db().rollback()
+        app.logger.exception('Ошибка изменения избранного')
+        return jsonify(error='Ошибка изменения избранного'), 500
+
+    if request.method == 'POST':
+        return jsonify(listing_id=listing_id, favorited=favorited)
+    return '', 204
+
 
 # ---------- АДМИНКА ----------
 # Маршруты и функции для административной панели.
@@ -666,36 +2646,107 @@ def admin_index():
         return redirect(url_for('rent')) # Перенаправление на страницу аренды
     return redirect(url_for('admin_users')) # Перенаправление на страницу управления пользователями
 
+def count_rows(table, source=None, clauses=(), values=()):
+    """
+    Быстрый подсчет строк для таблиц админки. Возвращает текст для страницы.
+    Строки считаются не дальше ADMIN_COUNT_LIMIT: точное число больших таблиц
+    требует полного прохода по ним. Если строк больше, для таблицы без фильтров
+    берется оценка из статистики планировщика (sqlite_stat1 после ANALYZE),
+    а с фильтрами показывается только нижняя граница.
+    """
+    limit = app.config['ADMIN_COUNT_LIMIT']
+    conn = get_db()
+    sql = f'SELECT 1 FROM {source or table}'
+    if clauses:
+        sql += f" WHERE {' AND '.join(clauses)}"
+    count = conn.execute(f'SELECT COUNT(*) FROM ({sql} LIMIT ?)', list(values) + [limit + 1]).fetchone()[0]
+    if count <= limit:
+        return str(count)
+    if not clauses:
+        try:
+            row = conn.execute('SELECT stat FROM sqlite_stat1 WHERE tbl = ? LIMIT 1', (table,)).fetchone()
+        except sqlite3.OperationalError:  # ANALYZE еще не выполнялся - таблицы статистики нет
+            row = None
+        if row and int(row[0].split()[0]) > limit:
+            return f'≈ {int(row[0].split()[0])}'
+    return f'более {limit}'
+
+
+def users_search_clauses(prefix):
+    """
+    Условия поиска пользователей по началу имени: (clauses, values).
+    Диапазон [prefix, prefix + максимальный символ) использует индекс по username,
+    в отличие от LIKE '%...%'.
+    """
+    if not prefix:
+        return [], []
+    return ['username >= ?', 'username < ?'], [prefix, prefix + '\U0010ffff']
+
+
+def fetch_users_page(prefix='', after=None, before=None):
+    """
+    Страница пользователей для админки: (users, next_cursor, prev_cursor).
+    Без поиска пользователи идут по id, при поиске - по имени: prefix ищется как начало
+    имени диапазоном по индексу UNIQUE(username) (с учетом регистра).
+    Пагинация по ключу, как у объявлений (см. fetch_listings_page).
+    """
+    page_size = app.config['ADMIN_PAGE_SIZE']
+    key = 'username' if prefix else 'id'
+    clauses, values = users_search_clauses(prefix)
+    backward = before is not None
+    cursor = before if backward else after
+    if cursor is not None:
+        clauses.append(f"{key} {'<' if backward else '>'} ?")
+        values.append(cursor)
+    sql = 'SELECT id, username, role FROM users'
+    if clauses:
+        sql += f" WHERE {' AND '.join(clauses)}"
+    sql += f" ORDER BY {key} {'DESC' if backward else 'ASC'} LIMIT ?"
+    values.append(page_size + 1)
+
+    users = get_db().execute(sql, values).fetchall()
+    has_more = len(users) > page_size
+    users = users[:page_size]
+    if backward:
+        users.reverse()
+    next_cursor = prev_cursor = None
+    if users:
+        if has_more or backward:
+            next_cursor = users[-1][key]
+        if (has_more and backward) or (after is not None and not backward):
+            prev_cursor = users[0][key]
+    return users, next_cursor, prev_cursor
+
+
 @app.route('/admin/users', methods=['GET'])
 @login_required # Требуется вход в систему
 def admin_users():
     """
     Страница управления пользователями в админ-панели.
-    Позволяет просматривать и искать пользователей.
+    Позволяет просматривать пользователей постранично и искать их по началу имени.
     """
     # Проверка роли администратора
-<<<<<<< Updated upstream
     if session.get('role') != 0:
         flash('Доступ запрещен.', 'danger')
         return redirect(url_for('rent'))
 
     # Получение параметра поиска из GET-запроса
-    search_username = request.args.get('search', '')
-    conn = sqlite3.connect('users.db')
-    conn.row_factory = sqlite3.Row
-    c = conn.cursor()
-
-    # Если есть поисковый запрос, фильтруем пользователей по имени
-    if search_username:
-        c.execute('SELECT * FROM users WHERE username LIKE ?', ('%' + search_username + '%',))
-    else:
-        # Иначе получаем всех пользователей
-        c.execute('SELECT * FROM users')
-    users = c.fetchall()
-    conn.close()
+    search_username = request.args.get('search', '').strip()
+    # Курсор страницы: имя при поиске, иначе id
+    cursor_type = str if search_username else (lambda value: int(value) if value.isdigit() else None)
+    after = request.args.get('after', type=cursor_type)
+    before = request.args.get('before', type=cursor_type)
+    users, next_cursor, prev_cursor = fetch_users_page(search_username, after, before)
+
+    clauses, values = users_search_clauses(search_username)
+    total = count_rows('users', clauses=clauses, values=values)
+    link_args = {'search': search_username} if search_username else {}
+    next_url = url_for('admin_users', after=next_cursor, **link_args) if next_cursor is not None else None
+    prev_url = url_for('admin_users', before=prev_cursor, **link_args) if prev_cursor is not None else None
 
     # Отображаем шаблон с пользователями
-    return render_template('admin_users.html', username=session.get('username'), users=users, title="Пользователи")
+    return render_template('admin_users.html', username=session.get('username'), users=users, title="Пользователи",
+                           total=total, next_url=next_url, prev_url=prev_url)
 
 @app.route('/admin/users/create', methods=['POST'])
 @login_required # Требуется вход в систему
@@ -714,14 +2765,13 @@ def create_user():
     role = int(request.form['role'])
 
     # Хеширование пароля
-    hashed_password = generate_password_hash(password)
+    hashed_password = hash_password(password)
 
-    conn = sqlite3.connect('users.db')
+    conn = get_db()
     c = conn.cursor()
     # Вставка нового пользователя в базу данных
     c.execute('INSERT INTO users (username, password, role) VALUES (?, ?, ?)', (username, hashed_password, role))
     conn.commit()
-    conn.close()
 
     flash('Пользователь создан.', 'user') # Сообщение об успехе
     return redirect(url_for('admin_users')) # Перенаправление на страницу управления пользователями
@@ -733,29 +2783,45 @@ def delete_user(user_id):
     Удаление пользователя администратором.
     """
     # Проверка роли администратора
-=======
->>>>>>> Stashed changes
->>>>>>> Stashed changes
     if session.get('role') != 0:
         flash('Доступ запрещен.', 'danger')
         return redirect(url_for('rent'))
 
-    conn = sqlite3.connect('users.db')
+    conn = get_db()
     c = conn.cursor()
     # Удаление пользователя из базы данных по ID
     c.execute('DELETE FROM users WHERE id = ?', (user_id,))
     conn.commit()
-    conn.close()
+    upload_cleaner.schedule() # Удаляем фото профиля в фоне, если на него больше нет ссылок
 
     flash('Пользователь удален.', 'user') # Сообщение об успехе
     return redirect(url_for('admin_users')) # Перенаправление на страницу управления пользователями
 
+def parse_admin_listing_filters(source):
+    """
+    Фильтры объявлений в админке (город, комнаты, тип жилья, тип сделки) из формы или строки запроса.
+    Возвращает (тип сделки или None, фильтры для build_listing_where, заданные параметры для ссылок).
+    Город ищется по началу слов через FTS5.
+    """
+    args = {name: str(source.get(name) or '').strip() for name in ('city', 'rooms', 'housing_type', 'deal_type')}
+    if args['deal_type'] not in ('rent', 'sale'):
+        args['deal_type'] = ''
+    filters = {}
+    if args['city'] and fts_query(args['city']):
+        filters['city_prefix'] = args['city']
+    if args['rooms'].isdigit():
+        filters['rooms'] = int(args['rooms'])
+    if args['housing_type']:
+        filters['housing_type'] = args['housing_type']
+    return args['deal_type'] or None, filters, {name: value for name, value in args.items() if value}
+
+
 @app.route('/admin/listings', methods=['GET'])
 @login_required # Требуется вход в систему
 def admin_listings():
     """
     Страница управления объявлениями в админ-панели.
-    Позволяет фильтровать и сортировать объявления.
+    Позволяет фильтровать и сортировать объявления; вывод постраничный.
     """
     # Проверка роли администратора
     if session.get('role') != 0:
@@ -763,58 +2829,46 @@ def admin_listings():
         return redirect(url_for('rent'))
 
     # Получение параметров фильтрации и сортировки из GET-запроса
-    city = request.args.get('city', '').strip()
-    rooms = request.args.get('rooms', '').strip()
-    housing_type = request.args.get('housing_type', '').strip()
-    deal_type = request.args.get('deal_type', '').strip()  # новый параметр для типа сделки
+    deal_type, filters, filter_args = parse_admin_listing_filters(request.args)
 
-    # Параметры сортировки
+    # Параметры сортировки: только колонки с индексами (id и цена)
     sort_by = request.args.get('sort_by', 'id') # Поле для сортировки
     order = request.args.get('order', 'asc') # Порядок сортировки (asc/desc)
     # Валидация параметров сортировки
-    if sort_by not in ['id', 'price', 'rooms', 'housing_type']:
+    if sort_by not in ['id', 'price']:
         sort_by = 'id'
     if order not in ['asc', 'desc']:
         order = 'asc'
 
-    conn = sqlite3.connect('users.db')
-    conn.row_factory = sqlite3.Row
-    c = conn.cursor()
-
-    # Базовый SQL-запрос для выборки объявлений с информацией о пользователе
-    query = '''
-        SELECT listings.*, users.username 
-        FROM listings 
-        LEFT JOIN users ON listings.user_id = users.id
-        WHERE 1=1
-    ''' 
-    params = [] # Список параметров для SQL-запроса
-
-    # Добавление условий фильтрации в запрос
-    if city:
-        query += ' AND city LIKE ?'
-        params.append(f'%{city}%')
-    if rooms and rooms.isdigit():
-        query += ' AND rooms = ?'
-        params.append(int(rooms))
-    if housing_type:
-        query += ' AND housing_type  = ?'
-        params.append(housing_type)
-    if deal_type:
-        query += ' AND deal_type = ?'
-        params.append(deal_type)
-
-    # Добавление сортировки в запрос
-    query += f' ORDER BY {sort_by} {order.upper()}'
-
-    c.execute(query, params)
-    listings = c.fetchall()
-    conn.close()
+    after = decode_cursor(request.args.get('after'), sort_by)
+    before = decode_cursor(request.args.get('before'), sort_by)
+    listings, next_cursor, prev_cursor = fetch_listings_page(
+        deal_type, filters, sort_by, after, before, page_size=app.config['ADMIN_PAGE_SIZE'],
+        fields=('id', 'price', 'rooms', 'housing_type', 'user_id'), descending=order == 'desc')
+
+    # Имена авторов - одним запросом для всей страницы
+    owner_ids = sorted({listing['user_id'] for listing in listings if listing['user_id'] is not None})
+    owners = {}
+    if owner_ids:
+        placeholders = ', '.join('?' for _ in owner_ids)
+        owners = dict(get_db().execute(f'SELECT id, username FROM users WHERE id IN ({placeholders})', owner_ids).fetchall())
+    for listing in listings:
+        listing['username'] = owners.get(listing['user_id'])
+
+    source, clauses, values = build_listing_where(deal_type, filters)
+    total = count_rows('listings', source, clauses, values)
+
+    # Ссылки пагинации и заголовков сортировки сохраняют фильтры
+    link_args = dict(filter_args, sort_by=sort_by, order=order)
+    next_url = url_for('admin_listings', after=next_cursor, **link_args) if next_cursor else None
+    prev_url = url_for('admin_listings', before=prev_cursor, **link_args) if prev_cursor else None
 
     # Отображение шаблона с отфильтрованными и отсортированными объявлениями
     return render_template('admin_listings.html', username=session.get('username'),
                            listings=listings, sort_by=sort_by, order=order,
-                           city=city, rooms=rooms, housing_type=housing_type, deal_type=deal_type)
+                           city=filter_args.get('city', ''), rooms=filter_args.get('rooms', ''),
+                           housing_type=filter_args.get('housing_type', ''), deal_type=filter_args.get('deal_type', ''),
+                           filter_args=filter_args, total=total, next_url=next_url, prev_url=prev_url)
 
 
 @app.route('/admin/listings/delete', methods=['POST'])
@@ -831,17 +2885,160 @@ def delete_listing():
     # Получение ID объявления для удаления из формы
     listing_id = int(request.form['listing_id'])
 
-    conn = sqlite3.connect('users.db')
+    conn = get_db()
     c = conn.cursor()
     # Удаление объявления из базы данных по ID
     c.execute('DELETE FROM listings WHERE id = ?', (listing_id,))
+    if c.rowcount:
+        bump_listings_version(conn)  # Результаты поиска в кэше больше не актуальны
     conn.commit()
-    conn.close()
+    upload_cleaner.schedule() # Удаляем фото объявления в фоне, если на него больше нет ссылок
 
     flash('Объявление удалено.', 'listing') # Сообщение об успехе
     return redirect(url_for('admin_listings')) # Перенаправление на страницу управления объявлениями
 
 
+def bulk_delete(listing_ids=(), listing_filter=None, user_ids=()):
+    """
+    Удаляет в одной транзакции объявления по списку id, объявления по фильтру
+    listing_filter = (тип сделки, фильтры build_listing_where) и пользователей
+    user_ids вместе с их объявлениями. Файлы загрузок, на которые больше нет ссылок,
+    удаляются в фоне (upload_cleaner).
+    Возвращает сводку: {'listings': ..., 'users': ..., 'files': ...}, где files - сколько
+    файлов загрузок освободило именно это удаление.
+    """
+    conn = get_db()
+    summary = {'listings': 0, 'users': 0, 'files': 0}
+    unreferenced = 'SELECT COUNT(*) FROM uploads WHERE refcount <= 0'
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        # Файлы без ссылок, оставшиеся от прежних удалений (их еще не убрал upload_cleaner)
+        pending_files = conn.execute(unreferenced).fetchone()[0]
+        # Списки id передаются одним параметром JSON: размер списка не ограничен числом параметров SQLite
+        if listing_ids:
+            summary['listings'] += conn.execute(
+                'DELETE FROM listings WHERE id IN (SELECT value FROM json_each(?))',
+                (json.dumps(list(listing_ids)),)).rowcount
+        if listing_filter is not None:
+            source, clauses, values = build_listing_where(*listing_filter)
+            summary['listings'] += conn.execute(
+                f"DELETE FROM listings WHERE id IN (SELECT listings.id FROM {source} WHERE {' AND '.join(clauses)})",
+                values).rowcount
+        if user_ids:
+            ids = json.dumps(list(user_ids))
+            summary['listings'] += conn.execute(
+                'DELETE FROM listings WHERE user_id IN (SELECT value FROM json_each(?))', (ids,)).rowcount
+            summary['users'] = conn.execute(
+                'DELETE FROM users WHERE id IN (SELECT value FROM json_each(?))', (ids,)).rowcount
+        if summary['listings']:
+            bump_listings_version(conn)  # Результаты поиска в кэше больше не актуальны
+        # Транзакция держит блокировку записи, поэтому разница - файлы, освобожденные этим удалением
+        summary['files'] = conn.execute(unreferenced).fetchone()[0] - pending_files
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        raise
+    if summary['files']:
+        upload_cleaner.schedule()
+    return summary
+
+
+def parse_id_list(values):
+    """
+    Список id из полей формы (повторяющиеся поля и/или значения через запятую) или из JSON.
+    Некорректные значения пропускаются.
+    """
+    ids = set()
+    for value in values:
+        for part in str(value).split(','):
+            part = part.strip()
+            if part.isdigit():
+                ids.add(int(part))
+    return sorted(ids)
+
+
+def bulk_delete_response(summary, endpoint):
+    """
+    Ответ на массовое удаление: сводка в JSON для запросов из скриптов,
+    flash-сообщение и возврат на страницу админки для формы.
+    """
+    if request.is_json or request.accept_mimetypes.best == 'application/json':
+        return jsonify(summary)
+    flash(f"Удалено объявлений: {summary['listings']}, пользователей: {summary['users']}. "
+          f"Файлов к удалению: {summary['files']}.", 'listing')
+    return redirect(request.referrer or url_for(endpoint))
+
+
+@app.route('/admin/listings/bulk_delete', methods=['POST'])
+@login_required # Требуется вход в систему
+def bulk_delete_listings():
+    """
+    Массовое удаление объявлений администратором: отмеченные в таблице (listing_id)
+    или все, подходящие под фильтры админки (scope=filter; без фильтров не выполняется).
+    Принимает форму или JSON {"listing_ids": [...]} / {"filter": {"city": ..., ...}}.
+    """
+    # Проверка роли администратора
+    if session.get('role') != 0:
+        flash('Доступ запрещен.', 'danger')
+        return redirect(url_for('rent'))
+
+    if request.is_json:
+        data = request.get_json(silent=True) or {}
+        listing_ids = parse_id_list(data.get('listing_ids') or [])
+        filter_source = data.get('filter') if isinstance(data.get('filter'), dict) else None
+    else:
+        listing_ids = parse_id_list(request.form.getlist('listing_id'))
+        filter_source = request.form if request.form.get('scope') == 'filter' else None
+
+    listing_filter = None
+    if filter_source is not None:
+        deal_type, filters, _ = parse_admin_listing_filters(filter_source)
+        # Защита от удаления всех объявлений: фильтр должен быть задан
+        if deal_type is None and not filters:
+            if request.is_json:
+                return jsonify(error='Не задан ни один фильтр'), 400
+            flash('Не задан ни один фильтр.', 'danger')
+            return redirect(request.referrer or url_for('admin_listings'))
+        listing_filter = (deal_type, filters)
+
+    return bulk_delete_response(bulk_delete(listing_ids, listing_filter), 'admin_listings')
+
+
+@app.route('/admin/users/bulk_delete', methods=['POST'])
+@login_required # Требуется вход в систему
+def bulk_delete_users():
+    """
+    Массовое удаление пользователей (user_id в форме или JSON {"user_ids": [...]})
+    вместе со всеми их объявлениями. Свою учетную запись администратор удалить не может.
+    """
+    # Проверка роли администратора
+    if session.get('role') != 0:
+        flash('Доступ запрещен.', 'danger')
+        return redirect(url_for('rent'))
+
+    if request.is_json:
+        user_ids = parse_id_list((request.get_json(silent=True) or {}).get('user_ids') or [])
+    else:
+        user_ids = parse_id_list(request.form.getlist('user_id'))
+    user_ids = [user_id for user_id in user_ids if user_id != session['user_id']]
+
+    return bulk_delete_response(bulk_delete(user_ids=user_ids), 'admin_users')
+
+
+@app.route('/admin/cache', methods=['GET'])
+@login_required # Требуется вход в систему
+def admin_cache_stats():
+    """
+    Статистика кэша результатов поиска (попадания, промахи, доля попаданий) в формате JSON.
+    """
+    # Проверка роли администратора
+    if session.get('role') != 0:
+        flash('Доступ запрещен.', 'danger')
+        return redirect(url_for('rent'))
+
+    return jsonify(listings_cache.stats())
+
+
 # ---------- ПРОФИЛЬ И АВТОРИЗАЦИЯ ----------
 # Маршруты и функции, связанные с профилем пользователя, входом, регистрацией и выходом.
 
@@ -854,8 +3051,7 @@ def profile():
     Отображает объявления, созданные текущим пользователем.
     """
     user_id = session.get('user_id')
-    conn = sqlite3.connect('users.db')
-    conn.row_factory = sqlite3.Row
+    conn = get_db()
     c = conn.cursor()
 
     # Если метод POST (т.е. пользователь обновляет профиль)
@@ -867,35 +3063,35 @@ def profile():
         if 'profile_image' in request.files:
             file = request.files['profile_image']
             if file and allowed_file(file.filename):
-                filename = secure_filename(file.filename)
-                image_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-                file.save(image_path)
-                profile_image = f"/static/uploads/{filename}"
+                profile_image, profile_image_variants = store_upload(conn, file, ('avatar',))
 
         # Обновление отображаемого имени, если оно было предоставлено
         if display_name:
             c.execute('UPDATE users SET display_name = ? WHERE id = ?', (display_name, user_id))
         # Обновление изображения профиля, если оно было загружено
         if profile_image:
-            c.execute('UPDATE users SET profile_image = ? WHERE id = ?', (profile_image, user_id))
+            c.execute('UPDATE users SET profile_image = ?, profile_image_variants = ? WHERE id = ?',
+                      (profile_image, profile_image_variants, user_id))
 
         conn.commit() # Сохранение изменений
+        if profile_image:
+            upload_cleaner.schedule() # Удаляем прежнее фото профиля в фоне, если на него больше нет ссылок
         flash("Профиль обновлен.", "success")
 
     # Получение актуальных данных пользователя (отображаемое имя, изображение)
-    c.execute("SELECT display_name, profile_image FROM users WHERE id = ?", (user_id,))
+    c.execute("SELECT display_name, profile_image, profile_image_variants FROM users WHERE id = ?", (user_id,))
     user = c.fetchone()
 
-    # Получение объявлений, созданных текущим пользователем
-    c.execute("SELECT * FROM listings WHERE user_id = ?", (user_id,))
-    listings = c.fetchall()
-
-    conn.close()
+    # Получение карточек объявлений, созданных текущим пользователем
+    cards = listing_card_cursor()
+    cards.execute(f"SELECT {listing_card_columns()} FROM listings WHERE user_id = ?", (user_id,))
+    listings = cards.fetchall()
 
     # Отображение шаблона профиля
     return render_template('profile.html',
                        display_name=user['display_name'] or session.get('username'), # Используем display_name, если есть, иначе username
                        profile_image=user['profile_image'],
+                       profile_image_variants=user['profile_image_variants'],
                        listings=listings,
                        )
 
@@ -914,15 +3110,19 @@ def login():
     username = request.form['username']
     password = request.form['password']
 
-    conn = sqlite3.connect('users.db')
+    conn = get_db()
     c = conn.cursor()
     # Ищем пользователя по имени
     c.execute("SELECT * FROM users WHERE username=?", (username,))
     user = c.fetchone() # Получаем данные пользователя (id, username, password_hash, role, ...)
-    conn.close()
 
     # Проверяем, найден ли пользователь и совпадает ли хеш пароля
-    if user and check_password_hash(user[2], password): # user[2] - это хешированный пароль
+    if user and verify_password(user[2], password): # user[2] - это хешированный пароль
+        # Хеш, полученный старым методом или с другой стоимостью, заменяем на новый
+        if password_needs_rehash(user[2]):
+            c.execute('UPDATE users SET password = ? WHERE id = ? AND password = ?',
+                      (hash_password(password), user[0], user[2]))
+            conn.commit()
         # Успешная аутентификация: сохраняем данные пользователя в сессии
         session['user_id'] = user[0] # id
         session['username'] = user[1] # username
@@ -945,17 +3145,8 @@ def register():
 
     # Валидация: проверка на наличие пробелов
     if ' ' in username or ' ' in password:
-<<<<<<< Updated upstream
-        flash('Пробелы запрещены в имени пользователя и пароле.', 'danger')
-<<<<<<< Updated upstream
         flash('Пробелы запрещены.', 'danger')
         # Отображаем главную страницу с активной формой регистрации
-=======
-=======
-        flash('Пробелы запрещены.', 'danger')
-        # Отображаем главную страницу с активной формой регистрации
->>>>>>> Stashed changes
->>>>>>> Stashed changes
         return render_template('index.html', show_register=True)
 
     # Валидация: проверка длины имени пользователя
@@ -969,140 +3160,152 @@ def register():
         return render_template('index.html', show_register=True)
 
     # Хеширование пароля
-    hashed_password = generate_password_hash(password)
+    hashed_password = hash_password(password)
 
     try:
-        conn = sqlite3.connect('users.db')
+        conn = get_db()
         c = conn.cursor()
         # Вставляем нового пользователя с ролью 1 (обычный пользователь)
         c.execute("INSERT INTO users (username, password, role) VALUES (?, ?, 1)", (username, hashed_password))
         conn.commit()
-<<<<<<< Updated upstream
-
-        # Получаем ID нового пользователя
-<<<<<<< Updated upstream
-        # Получаем ID и роль только что созданного пользователя для сессии
-=======
-=======
         # Получаем ID и роль только что созданного пользователя для сессии
->>>>>>> Stashed changes
->>>>>>> Stashed changes
         c.execute("SELECT id, role FROM users WHERE username = ?", (username,))
         user = c.fetchone()
-        conn.close()
-
-<<<<<<< Updated upstream
-        # Сохраняем в сессию
-        session['user_id'] = user[0]
-        # Автоматический вход после регистрации
-        session['user_id'] = user[0] # id
-        session['username'] = username
-        session['role'] = user[1]
 
-        return redirect('/rent' if user[1] == 1 else '/admin')
-<<<<<<< Updated upstream
-        session['role'] = user[1] # role
-        # Перенаправляем на страницу аренды (т.к. роль по умолчанию 1)
-        return redirect('/rent' if user[1] == 1 else '/admin') # '/admin' здесь маловероятно, т.к. role=1
-=======
-=======
         # Автоматический вход после регистрации
         session['user_id'] = user[0] # id
         session['username'] = username
         session['role'] = user[1] # role
         # Перенаправляем на страницу аренды (т.к. роль по умолчанию 1)
         return redirect('/rent' if user[1] == 1 else '/admin') # '/admin' здесь маловероятно, т.к. role=1
->>>>>>> Stashed changes
->>>>>>> Stashed changes
 
     except sqlite3.IntegrityError:
         # Если имя пользователя уже существует (из-за UNIQUE ограничения в БД)
         flash('Имя пользователя уже существует.', 'danger')
-<<<<<<< Updated upstream
-        return redirect(url_for('index'))
         return redirect(url_for('index')) # Возвращаем на главную страницу
 
 @app.route('/logout')
 def logout():
-    session.clear()
     """
     Обрабатывает выход пользователя из системы.
     Очищает сессию.
     """
     session.clear() # Удаляем все данные из сессии
     flash('Вы вышли из аккаунта.', 'success')
-    return redirect(url_for('index'))
-
-@app.route('/rent', methods=['GET', 'POST'])
-def rent():
-    conn = sqlite3.connect('users.db')
-    conn.row_factory = sqlite3.Row
-    c = conn.cursor()
-<<<<<<< Updated upstream
     return redirect(url_for('index')) # Перенаправляем на главную страницу
-=======
-=======
-        return redirect(url_for('index')) # Возвращаем на главную страницу
->>>>>>> Stashed changes
 
-@app.route('/logout')
-def logout():
+
+# ---------- API ----------
+# JSON API только для чтения: те же фильтры, что у /rent и /sale, постраничный вывод
+# по курсорам, выбор полей и потоковая выгрузка в формате NDJSON.
+
+# Поля объявления, доступные через API (параметр fields)
+API_LISTING_FIELDS = ('id', 'deal_type', 'housing_type', 'city', 'price', 'rooms', 'area',
+                      'description', 'details', 'phone', 'image', 'latitude', 'longitude', 'user_id')
+
+
+def parse_api_fields(value):
     """
-    Обрабатывает выход пользователя из системы.
-    Очищает сессию.
+    Разбирает параметр fields ("id,price,city"). Возвращает кортеж полей
+    (все поля, если параметр не задан) или None, если указано неизвестное поле.
     """
-    session.clear() # Удаляем все данные из сессии
-    flash('Вы вышли из аккаунта.', 'success')
-    return redirect(url_for('index')) # Перенаправляем на главную страницу
->>>>>>> Stashed changes
+    if not value:
+        return API_LISTING_FIELDS
+    fields = tuple(dict.fromkeys(name.strip() for name in value.split(',') if name.strip()))
+    if not fields or any(name not in API_LISTING_FIELDS for name in fields):
+        return None
+    return fields
 
 
-<<<<<<< Updated upstream
-    if request.method == 'POST':
-        min_price = request.form.get('min_price')
-        max_price = request.form.get('max_price')
-        rooms = request.form.get('rooms')
-        district = request.form.get('district')
-        type_of_property = request.form.get('type')
-# ---------- ГЛАВНАЯ ----------
-# Маршрут для главной страницы приложения.
+def iter_listings_ndjson(deal_type, filters, sort, fields, after=None):
+    """
+    Генератор строк NDJSON (один объект объявления на строку) для потоковой выгрузки.
+    Строки читаются из курсора SQLite порциями, поэтому расход памяти
+    не зависит от количества выгружаемых объявлений.
+    """
+    columns = ', '.join(f'listings.{name}' for name in fields)
+    sql, values = listing_page_query(deal_type, filters, sort, columns, after=after)
+    c = get_db().cursor()
+    c.row_factory = None
+    c.arraysize = app.config['API_STREAM_BATCH_SIZE']
+    c.execute(sql, values)
+    try:
+        while True:
+            rows = c.fetchmany()
+            if not rows:
+                break
+            yield ''.join(json.dumps(dict(zip(fields, row)), ensure_ascii=False) + '\n' for row in rows)
+    finally:
+        c.close()
 
-        if min_price:
-            filters.append("price >= ?")
-            values.append(int(min_price))
-        if max_price:
-            filters.append("price <= ?")
-            values.append(int(max_price))
-        if rooms:
-            filters.append("rooms = ?")
-            values.append(int(rooms))
-        if district:
-            filters.append("district = ?")
-            values.append(district)
-        if type_of_property:
-            filters.append("type = ?")
-            values.append(type_of_property)
-
-    city = request.args.get('city')
-    if city:
-        filters.append("city = ?")
-        values.append(city)
-
-    if filters:
-        query += " AND " + " AND ".join(filters)
-<<<<<<< Updated upstream
-@app.route('/')
-def index():
+
+@app.route('/api/listings')
+def api_listings():
     """
-    Отображает главную страницу приложения (index.html).
-    Эта страница обычно содержит формы входа и регистрации.
+    Список объявлений в JSON.
+    Параметры: deal_type (rent/sale, по умолчанию - все), фильтры min_price, max_price, rooms,
+    city, housing_type, q, сортировка sort (id, price, relevance), курсоры after/before,
+    limit (размер страницы) и fields (список полей через запятую).
+    С format=ndjson (или Accept: application/x-ndjson) отдает все подходящие объявления
+    потоком, по одному JSON-объекту на строку, начиная с курсора after.
     """
-    return render_template('index.html')
-=======
-=======
+    deal_type = request.args.get('deal_type') or None
+    if deal_type not in (None, 'rent', 'sale'):
+        return jsonify(error='deal_type должен быть rent или sale'), 400
+    fields = parse_api_fields(request.args.get('fields'))
+    if fields is None:
+        return jsonify(error='Допустимые поля: ' + ', '.join(API_LISTING_FIELDS)), 400
+
+    filters = parse_listing_filters(request.args)
+    default_sort = 'relevance' if 'q' in filters else 'id'
+    sort = request.args.get('sort') or default_sort
+    if sort not in LISTING_SORTS or (LISTING_SORTS[sort].get('search') and 'q' not in filters):
+        return jsonify(error='Недопустимая сортировка'), 400
+    after = decode_cursor(request.args.get('after'), sort)
+    before = decode_cursor(request.args.get('before'), sort)
+
+    ndjson = (request.args.get('format') == 'ndjson'
+              or request.accept_mimetypes.best == 'application/x-ndjson')
+    if ndjson:
+        return app.response_class(
+            stream_with_context(iter_listings_ndjson(deal_type, filters, sort, fields, after)),
+            mimetype='application/x-ndjson')
+
+    limit = request.args.get('limit', type=int) or app.config['LISTINGS_PAGE_SIZE']
+    limit = max(1, min(limit, app.config['API_MAX_PAGE_SIZE']))
+    listings, next_cursor, prev_cursor = fetch_listings_page(
+        deal_type, filters, sort, after, before, page_size=limit, fields=fields)
+
+    # Ссылки на соседние страницы повторяют все параметры запроса, кроме курсоров
+    link_args = {key: value for key, value in request.args.items() if key not in ('after', 'before')}
+    return jsonify(
+        listings=listings,
+        next_cursor=next_cursor,
+        prev_cursor=prev_cursor,
+        next=url_for('api_listings', after=next_cursor, **link_args) if next_cursor else None,
+        prev=url_for('api_listings', before=prev_cursor, **link_args) if prev_cursor else None,
+    )
+
+
+@app.route('/api/listings/<int:listing_id>')
+def api_listing(listing_id):
+    """
+    Одно объявление в JSON (параметр fields - как у /api/listings).
+    """
+    fields = parse_api_fields(request.args.get('fields'))
+    if fields is None:
+        return jsonify(error='Допустимые поля: ' + ', '.join(API_LISTING_FIELDS)), 400
+    c = get_db().cursor()
+    c.row_factory = None
+    c.execute(f"SELECT {', '.join(fields)} FROM listings WHERE id = ?", (listing_id,))
+    row = c.fetchone()
+    if row is None:
+        return jsonify(error='Объявление не найдено'), 404
+    return jsonify(dict(zip(fields, row)))
+
+
 # ---------- ГЛАВНАЯ ----------
 # Маршрут для главной страницы приложения.
->>>>>>> Stashed changes
 
 @app.route('/')
 def index():
@@ -1111,34 +3314,560 @@ def index():
     Эта страница обычно содержит формы входа и регистрации.
     """
     return render_template('index.html')
->>>>>>> Stashed changes
 
 
-<<<<<<< Updated upstream
-    return render_template('rent.html', listings=listings)
-@app.route('/profile')
-@login_required
-def profile():
-    return render_template('profile.html', username=session.get('username'))
-<<<<<<< Updated upstream
-# ---------- ЗАПУСК ----------
-# Код для запуска Flask-приложения.
-=======
-=======
+# ---------- КОМАНДЫ CLI ----------
+# Массовый импорт и экспорт данных:
+#   flask --app server import-users users.csv
+#   flask --app server import-listings listings.jsonl
+#   flask --app server export-listings listings.jsonl
+
+# Индексы listings пересоздаются после импорта, а не обновляются на каждую строку;
+# эти триггеры тоже отключаются на время импорта, а FTS и R*Tree заполняются одним запросом
+DEFERRED_LISTING_TRIGGERS = ('listings_fts_insert', 'listings_geo_insert')
+
+
+def read_import_rows(path):
+    """
+    Потоково читает файл импорта: CSV с заголовком или JSONL (.jsonl, .ndjson) - по расширению.
+    Возвращает пары (номер строки, словарь полей); для нечитаемой строки JSONL - (номер, None).
+    """
+    with open(path, encoding='utf-8', newline='') as f:
+        if path.endswith(('.jsonl', '.ndjson')):
+            for number, line in enumerate(f, 1):
+                if not line.strip():
+                    continue
+                try:
+                    row = json.loads(line)
+                except ValueError:
+                    row = None
+                yield number, (row if isinstance(row, dict) else None)
+        else:
+            reader = csv.DictReader(f)
+            for row in reader:
+                yield reader.line_num, row
+
+
+def batched(iterable, size):
+    """
+    Разбивает последовательность на списки длиной не больше size.
+    """
+    iterator = iter(iterable)
+    while True:
+        batch = list(itertools.islice(iterator, size))
+        if not batch:
+            return
+        yield batch
+
+
+class ImportReport:
+    """
+    Счетчики импорта: сколько строк добавлено и пропущено, первые ошибки и скорость.
+    """
+
+    # Сколько ошибок выводится подробно
+    MAX_ERRORS_SHOWN = 20
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.imported = 0
+        self.skipped = 0
+        self.failed = 0
+        self.errors = []
+
+    def error(self, number, message):
+        self.skipped += 1
+        self.failed += 1
+        if len(self.errors) < self.MAX_ERRORS_SHOWN:
+            self.errors.append(f'строка {number}: {message}')
+
+    def echo(self, what):
+        elapsed = time.perf_counter() - self.started
+        for message in self.errors:
+            click.echo(message, err=True)
+        if self.failed > len(self.errors):
+            click.echo(f'... и еще {self.failed - len(self.errors)} ошибок', err=True)
+        rate = self.imported / elapsed if elapsed else 0
+        click.echo(f'{what}: добавлено {self.imported}, пропущено {self.skipped} '
+                   f'за {elapsed:.2f} с ({rate:.0f} строк/с)')
+
+
+def _drop_deferred_listing_objects(conn):
+    """
+    Удаляет индексы listings и триггеры из DEFERRED_LISTING_TRIGGERS.
+    Возвращает их SQL-определения для последующего восстановления.
+    """
+    placeholders = ', '.join('?' for _ in DEFERRED_LISTING_TRIGGERS)
+    objects = conn.execute(f'''
+        SELECT type, name, sql FROM sqlite_master
+        WHERE tbl_name = 'listings' AND sql IS NOT NULL
+          AND (type = 'index' OR (type = 'trigger' AND name IN ({placeholders})))
+    ''', DEFERRED_LISTING_TRIGGERS).fetchall()
+    for kind, name, _ in objects:
+        conn.execute(f'DROP {kind.upper()} {name}')
+    return [sql for _, _, sql in objects]
+
+
+def _restore_deferred_listing_objects(conn, deferred, last_id):
+    """
+    Завершает загрузку с отложенными индексами: добавляет новые строки (id > last_id)
+    в FTS и R*Tree одним проходом и восстанавливает удаленные индексы и триггеры.
+    """
+    conn.execute('''
+        INSERT INTO listings_fts (rowid, description, details, city)
+        SELECT id, description, details, city FROM listings WHERE id > ?
+    ''', (last_id,))
+    conn.execute('''
+        INSERT INTO listings_geo
+        SELECT id, latitude, latitude, longitude, longitude FROM listings
+        WHERE id > ? AND latitude IS NOT NULL AND longitude IS NOT NULL
+    ''', (last_id,))
+    for sql in deferred:
+        conn.execute(sql)
+
+
+@app.cli.command('import-users')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--batch-size', default=5000, show_default=True, help='Строк в одном executemany.')
+def import_users_command(path, batch_size):
+    """
+    Импорт пользователей из CSV или JSONL.
+    Поля: username, password (будет захеширован) или password_hash (уже готовый хеш),
+    role (0 - администратор, 1 - пользователь; по умолчанию 1), display_name.
+    Пользователи с уже существующим username пропускаются.
+    Весь файл импортируется в одной транзакции.
+    """
+    init_db()  # Схема базы должна быть актуальной
+    report = ImportReport()
+
+    def rows():
+        for number, row in read_import_rows(path):
+            username = str((row or {}).get('username') or '').strip()
+            if not username:
+                report.error(number, 'не заполнено поле "username"')
+                continue
+            try:
+                password_hash = row.get('password_hash') or (
+                    hash_password(str(row['password'])) if row.get('password') else None)
+            except PasswordHashBusy:
+                report.error(number, 'пароль не удалось захешировать: пул хеширования перегружен')
+                continue
+            if not password_hash:
+                report.error(number, 'нужно поле "password" или "password_hash"')
+                continue
+            try:
+                role = int(row.get('role') if row.get('role') not in (None, '') else 1)
+            except ValueError:
+                role = None
+            if role not in (0, 1):
+                report.error(number, 'роль должна быть 0 или 1')
+                continue
+            yield username, password_hash, role, row.get('display_name') or None
+
+    conn = connect_db()
+    try:
+        conn.execute('BEGIN IMMEDIATE')
+        for batch in batched(rows(), batch_size):
+            before = conn.total_changes
+            conn.executemany('''
+                INSERT INTO users (username, password, role, display_name) VALUES (?, ?, ?, ?)
+                ON CONFLICT (username) DO NOTHING
+            ''', batch)
+            added = conn.total_changes - before
+            report.imported += added
+            report.skipped += len(batch) - added  # такой username уже есть
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+    report.echo('Пользователи')
+
+
+@app.cli.command('import-listings')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--batch-size', default=5000, show_default=True, help='Строк в одном executemany.')
+@click.option('--defer-indexes/--no-defer-indexes', default=True, show_default=True,
+              help='Пересоздать индексы и заполнить поисковые индексы после загрузки '
+                   '(быстрее, если импортируется много строк относительно размера таблицы).')
+def import_listings_command(path, batch_size, defer_indexes):
+    """
+    Импорт объявлений из CSV или JSONL.
+    Поля - как в форме добавления объявления (price, rooms, description, details, deal_type,
+    housing_type, city, area, phone, latitude, longitude) и проверяются по тем же правилам;
+    владелец задается полем user_id или username, image - URL уже загруженного изображения.
+    Весь файл импортируется в одной транзакции: при ошибке база не меняется.
+    """
+    init_db()  # Схема базы должна быть актуальной
+    report = ImportReport()
+    conn = connect_db()
+    user_ids = {}
+    known_ids = {}
+
+    def owner(row):
+        # Владелец по id или по имени пользователя (результаты поиска кэшируются на время импорта)
+        if row.get('user_id') not in (None, ''):
+            try:
+                user_id = int(row['user_id'])
+            except (TypeError, ValueError):
+                raise ValueError(f'Некорректный user_id "{row["user_id"]}".')
+            if user_id not in known_ids:
+                known_ids[user_id] = conn.execute('SELECT 1 FROM users WHERE id = ?', (user_id,)).fetchone() is not None
+            if not known_ids[user_id]:
+                raise ValueError(f'Пользователь с id {user_id} не найден.')
+            return user_id
+        username = row.get('username')
+        if not username:
+            return None
+        if username not in user_ids:
+            found = conn.execute('SELECT id FROM users WHERE username = ?', (username,)).fetchone()
+            user_ids[username] = found[0] if found else None
+        if user_ids[username] is None:
+            raise ValueError(f'Пользователь "{username}" не найден.')
+        return user_ids[username]
+
+    def rows():
+        for number, row in read_import_rows(path):
+            if row is None:
+                report.error(number, 'строка не является JSON-объектом')
+                continue
+            try:
+                fields = parse_listing_fields(row)
+                fields['user_id'] = owner(row)
+            except ValueError as error:
+                report.error(number, str(error))
+                continue
+            fields['image'] = row.get('image') or None
+            yield fields
+
+    try:
+        conn.execute('BEGIN IMMEDIATE')
+        last_id = conn.execute('SELECT COALESCE(MAX(id), 0) FROM listings').fetchone()[0]
+        deferred = _drop_deferred_listing_objects(conn) if defer_indexes else []
+        for batch in batched(rows(), batch_size):
+            conn.executemany('''
+                INSERT INTO listings
+                (image, price, rooms, description, details, deal_type, housing_type, city, area, phone, user_id,
+                 latitude, longitude)
+                VALUES (:image, :price, :rooms, :description, :details, :deal_type, :housing_type,
+                        :city, :area, :phone, :user_id, :latitude, :longitude)
+            ''', batch)
+            report.imported += len(batch)
+        if defer_indexes:
+            _restore_deferred_listing_objects(conn, deferred, last_id)
+        if report.imported:
+            bump_listings_version(conn)  # Результаты поиска в кэше больше не актуальны
+        conn.commit()
+        conn.execute('PRAGMA optimize')  # Обновление статистики планировщика после большой загрузки
+    except BaseException:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+    report.echo('Объявления')
+
+
+@app.cli.command('export-listings')
+@click.argument('output', type=click.File('w', encoding='utf-8'), default='-')
+@click.option('--format', 'fmt', type=click.Choice(['jsonl', 'csv']), default='jsonl', show_default=True)
+@click.option('--deal-type', type=click.Choice(DEAL_TYPES), help='Только аренда или только продажа.')
+def export_listings_command(output, fmt, deal_type):
+    """
+    Экспорт объявлений в JSONL или CSV (по умолчанию - в stdout).
+    Строки читаются из курсора порциями, поэтому память не зависит от размера таблицы.
+    Результат можно снова загрузить командой import-listings.
+    """
+    started = time.perf_counter()
+    conn = connect_db()
+    c = conn.cursor()
+    c.row_factory = None
+    c.arraysize = app.config['API_STREAM_BATCH_SIZE']
+    where = 'WHERE deal_type = ?' if deal_type else ''
+    c.execute(f"SELECT {', '.join(API_LISTING_FIELDS)} FROM listings {where} ORDER BY id",
+              (deal_type,) if deal_type else ())
+    writer = None
+    if fmt == 'csv':
+        writer = csv.writer(output)
+        writer.writerow(API_LISTING_FIELDS)
+    count = 0
+    try:
+        while True:
+            rows = c.fetchmany()
+            if not rows:
+                break
+            if writer:
+                writer.writerows(rows)
+            else:
+                output.write(''.join(json.dumps(dict(zip(API_LISTING_FIELDS, row)), ensure_ascii=False) + '\n'
+                                     for row in rows))
+            count += len(rows)
+    finally:
+        conn.close()
+    elapsed = time.perf_counter() - started
+    click.echo(f'Экспортировано {count} объявлений за {elapsed:.2f} с', err=True)
+
+
+@app.cli.command('gc-uploads')
+@click.option('--dry-run', is_flag=True, help='Только показать файлы без ссылок, ничего не удаляя.')
+@click.option('--grace-period', type=int, default=None, help='Не трогать файлы моложе N секунд.')
+@click.option('--rate', type=int, default=None, help='Сколько файлов в секунду просматривать (0 - без ограничения).')
+@click.option('--batch-size', default=200, show_default=True, help='Сколько файлов проверять одним запросом.')
+def gc_uploads_command(dry_run, grace_period, rate, batch_size):
+    """
+    Удаляет из папки загрузок файлы, на которые не ссылается ни одно объявление и ни один профиль.
+    Рассчитана на периодический запуск (например, из cron) при работающем сайте.
+    """
+    if grace_period is None:
+        grace_period = app.config['UPLOAD_GC_GRACE_PERIOD']
+    if rate is None:
+        rate = app.config['UPLOAD_GC_RATE']
+    init_db()
+    started = time.perf_counter()
+    echo = (lambda url, size: click.echo(f'{url}\t{size}')) if dry_run else None
+    report = collect_upload_garbage(grace_period, dry_run, batch_size, rate, echo)
+    action = 'Найдено' if dry_run else 'Удалено'
+    count = report['orphans'] if dry_run else report['removed']
+    click.echo(f"Просмотрено файлов: {report['scanned']} (новых: {report['recent']}). "
+               f"{action} файлов без ссылок: {count} ({report['bytes'] / 1024 / 1024:.1f} МБ) "
+               f"за {time.perf_counter() - started:.1f} с", err=True)
+
+
 # ---------- ЗАПУСК ----------
 # Код для запуска Flask-приложения.
->>>>>>> Stashed changes
->>>>>>> Stashed changes
+# Для разработки - python server.py (отладочный сервер с перезагрузкой).
+# Для работы сайта - flask --app server serve: миграции выполняются один раз в главном
+# процессе, затем он создает слушающий сокет и запускает (fork) несколько рабочих процессов,
+# каждый со своим пулом потоков. Главный процесс перезапускает упавшие рабочие процессы;
+# SIGHUP - плавная перезагрузка с новым кодом, SIGTERM или SIGINT - плавная остановка.
+
+# Рабочий процесс получил команду завершиться (проверка готовности отвечает 503)
+shutting_down = threading.Event()
+
+
+@app.route('/readyz')
+def readiness():
+    """
+    Проверка готовности для балансировщика и оркестратора: 200, если процесс
+    принимает запросы, база доступна и ее схема не старее кода; иначе 503.
+    """
+    status = {'pid': os.getpid()}
+    try:
+        status['schema_version'] = get_db().execute('PRAGMA user_version').fetchone()[0]
+    except sqlite3.Error as error:
+        status.update(status='error', error=str(error))
+    else:
+        if shutting_down.is_set():
+            status['status'] = 'stopping'
+        elif status['schema_version'] < len(MIGRATIONS):
+            status['status'] = 'migrating'
+        else:
+            status['status'] = 'ok'
+    response = jsonify(status)
+    response.status_code = 200 if status['status'] == 'ok' else 503
+    response.headers['Cache-Control'] = 'no-store'
+    return response
+
+
+class PooledWSGIServer(BaseWSGIServer):
+    """
+    HTTP-сервер рабочего процесса с фиксированным пулом потоков. Когда все потоки заняты,
+    процесс перестает принимать соединения, и они достаются другим рабочим процессам.
+    """
+    multithread = True
+    multiprocess = True
+
+    def __init__(self, app, fd, address, threads, handler):
+        self._slots = threading.BoundedSemaphore(threads)
+        self._executor = ThreadPoolExecutor(threads, thread_name_prefix='http')
+        super().__init__(address[0], address[1], app, handler=handler, fd=fd)
+
+    def process_request(self, request, client_address):
+        self._slots.acquire()
+        self._executor.submit(self._process_request, request, client_address)
+
+    def _process_request(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+            self._slots.release()
+
+    def drain(self):
+        """
+        Дожидается завершения запросов, которые уже обрабатываются.
+        """
+        self._executor.shutdown(wait=True)
+
+
+def _run_worker(fd, address, threads):
+    """
+    Тело рабочего процесса: обслуживает запросы до SIGTERM, затем завершает
+    начатые запросы и выходит.
+    """
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # Ctrl+C обрабатывает главный процесс
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+    handler = type('RequestHandler', (WSGIRequestHandler,), {
+        'protocol_version': 'HTTP/1.1',  # Ответы без Content-Length передаются частями (chunked)
+        'timeout': app.config['SERVER_CLIENT_TIMEOUT'],
+    })
+    httpd = PooledWSGIServer(app, fd, address, threads, handler)
+
+    def stop(signum, frame):
+        shutting_down.set()
+        # shutdown() ждет выхода из serve_forever(), поэтому вызывается из другого потока
+        threading.Thread(target=httpd.shutdown, daemon=True).start()
+
+    signal.signal(signal.SIGTERM, stop)
+    try:
+        httpd.serve_forever()  # После shutdown() перестает принимать соединения и закрывает сокет
+    finally:
+        httpd.drain()
+
+
+def _spawn_worker(listener, threads):
+    """
+    Запускает рабочий процесс (fork) и возвращает его pid.
+    """
+    pid = os.fork()
+    if pid:
+        return pid
+    code = 0
+    try:
+        _run_worker(listener.fileno(), listener.getsockname(), threads)
+    except BaseException:
+        app.logger.exception('Рабочий процесс %s завершился с ошибкой', os.getpid())
+        code = 1
+    finally:
+        os._exit(code)  # Не выполняем код главного процесса (обработчики click, atexit)
+
+
+def serve(host, port, workers, threads, echo=print):
+    """
+    Главный процесс: миграции, сокет, запуск и надзор за рабочими процессами.
+    При SIGHUP главный процесс заново запускает себя (exec) с тем же сокетом:
+    новый код загружается, новые рабочие процессы начинают принимать соединения,
+    и только после этого старые плавно завершаются.
+    """
+    startup = time.perf_counter()
+    report = [f'загрузка приложения {startup - _module_loaded_at:.2f} с']
+
+    # Схема базы обновляется один раз, до запуска рабочих процессов
+    started = time.perf_counter()
+    init_db()
+    conn = connect_db()
+    schema_version = conn.execute('PRAGMA user_version').fetchone()[0]
+    conn.close()
+    report.append(f'миграции {time.perf_counter() - started:.2f} с (схема v{schema_version})')
+
+    # При перезагрузке сокет и список старых рабочих процессов передаются через окружение
+    inherited_fd = os.environ.pop('SERVER_LISTEN_FD', None)
+    old_workers = [int(pid) for pid in os.environ.pop('SERVER_OLD_WORKERS', '').split(',') if pid]
+    if inherited_fd:
+        listener = socket.socket(fileno=int(inherited_fd))
+    else:
+        listener = socket.create_server((host, port), backlog=app.config['SERVER_BACKLOG'])
+    address = listener.getsockname()
+
+    state = {'stop': False, 'reload': False}
+    signal.signal(signal.SIGTERM, lambda signum, frame: state.update(stop=True))
+    signal.signal(signal.SIGINT, lambda signum, frame: state.update(stop=True))
+    signal.signal(signal.SIGHUP, lambda signum, frame: state.update(reload=True))
+
+    started = time.perf_counter()
+    children = {_spawn_worker(listener, threads): time.monotonic() for _ in range(workers)}
+    report.append(f'запуск {workers} процессов по {threads} потоков {time.perf_counter() - started:.2f} с')
+    echo(f"Сервер слушает http://{address[0]}:{address[1]} (pid {os.getpid()}); "
+         f"готов за {time.perf_counter() - startup:.2f} с: {', '.join(report)}; "
+         f"Pillow: {'да' if Image else 'нет'}, brotli: {'да' if brotli else 'нет'}")
+
+    # Новые процессы уже принимают соединения - старые (до перезагрузки) завершают свои запросы
+    for pid in old_workers:
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except ProcessLookupError:
+            pass
+    retiring = {pid: time.monotonic() for pid in old_workers}
+
+    while not state['stop'] and not state['reload']:
+        time.sleep(0.2)
+        # Собираем завершившиеся процессы и заменяем упавшие
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                break
+            if not pid:
+                break
+            retiring.pop(pid, None)
+            if pid in children:
+                lifetime = time.monotonic() - children.pop(pid)
+                echo(f'Рабочий процесс {pid} завершился (код {os.waitstatus_to_exitcode(status)}), запускаем новый')
+                if lifetime < 1:
+                    time.sleep(1)  # Процесс падает сразу после запуска - не перезапускаем его в цикле
+                children[_spawn_worker(listener, threads)] = time.monotonic()
+        # Старые процессы, не успевшие завершиться за SERVER_GRACEFUL_TIMEOUT, останавливаем принудительно
+        for pid, since in list(retiring.items()):
+            if time.monotonic() - since > app.config['SERVER_GRACEFUL_TIMEOUT']:
+                _kill(pid)
+                retiring.pop(pid)
+
+    if state['reload']:
+        echo('Перезагрузка: запускаем новый код')
+        listener.set_inheritable(True)
+        os.environ['SERVER_LISTEN_FD'] = str(listener.fileno())
+        os.environ['SERVER_OLD_WORKERS'] = ','.join(str(pid) for pid in list(children) + list(retiring))
+        os.execv(sys.executable, [sys.executable] + sys.orig_argv[1:])
+
+    echo('Остановка: ждем завершения начатых запросов')
+    for pid in children:
+        os.kill(pid, signal.SIGTERM)
+    deadline = time.monotonic() + app.config['SERVER_GRACEFUL_TIMEOUT']
+    remaining = set(children) | set(retiring)
+    while remaining and time.monotonic() < deadline:
+        try:
+            pid, _ = os.waitpid(-1, os.WNOHANG)
+        except ChildProcessError:
+            break
+        if pid:
+            remaining.discard(pid)
+        else:
+            time.sleep(0.1)
+    for pid in remaining:
+        _kill(pid)
+    listener.close()
+
+
+def _kill(pid):
+    """
+    Принудительно завершает рабочий процесс, который не остановился сам.
+    """
+    try:
+        os.kill(pid, signal.SIGKILL)
+        os.waitpid(pid, 0)
+    except (ProcessLookupError, ChildProcessError):
+        pass
+
+
+@app.cli.command('serve', with_appcontext=False)
+@click.option('--host', default='127.0.0.1', show_default=True)
+@click.option('--port', default=8000, show_default=True)
+@click.option('--workers', type=int, default=None, help='Количество рабочих процессов (по умолчанию SERVER_WORKERS).')
+@click.option('--threads', type=int, default=None, help='Потоков в каждом процессе (по умолчанию SERVER_THREADS).')
+def serve_command(host, port, workers, threads):
+    """
+    Запускает сайт в рабочем режиме: несколько процессов с пулами потоков.
+    """
+    serve(host, port, workers or app.config['SERVER_WORKERS'], threads or app.config['SERVER_THREADS'],
+          echo=lambda message: click.echo(message, err=True))
+
 
 if __name__ == '__main__':
+    # Процессы пула паролей заново импортировали бы этот файл как главный модуль (с манифестом,
+    # кэшами и приложением), поэтому отладочный сервер хеширует пароли в потоке запроса
+    app.config['PASSWORD_HASH_WORKERS'] = 0
     # Инициализируем базу данных при первом запуске (или если таблицы не созданы)
     init_db()
-<<<<<<< Updated upstream
-    app.run(debug=True)
-<<<<<<< Updated upstream
-    app.run(debug=True)
-=======
-=======
     app.run(debug=True)
->>>>>>> Stashed changes
->>>>>>> Stashed changes
@@ -0,0 +1,28 @@
+"""
+Проверки пакета bench.
+"""
+import server
+from bench import runner
+from bench.dataset import generate
+
+
+def test_client_worker_renders_streamed_listings(tmp_path, monkeypatch):
+    # Страницы /rent и /sale отдаются потоком: без чтения тела выборка объявлений не выполняется
+    path = str(tmp_path / 'bench.db')
+    generate(path, listings=50, users=5, favorites=10, echo=lambda *args: None)
+    monkeypatch.setitem(server.app.config, 'DATABASE', path)
+    monkeypatch.setitem(server.app.config, 'LISTINGS_STREAM', True)
+    server.init_db()
+
+    pages = []
+    iterate = server.ListingsPage.__iter__
+
+    def counting_iter(self):
+        pages.append(self)
+        return iterate(self)
+
+    monkeypatch.setattr(server.ListingsPage, '__iter__', counting_iter)
+    worker = runner.ClientWorker(None, 'user')
+    assert worker.get('/rent') == 200
+    assert worker.get('/sale') == 200
+    assert len(pages) == 2